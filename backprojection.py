@@ -0,0 +1,87 @@
+"""
+backprojection module that expresses the delay-and-sum backprojection of
+recon_loop as a sparse linear operator.
+
+The operator is a CSR matrix from A-line space, i.e. pa_data flattened
+in Fortran order (sample, then detector), to the pixels of the image,
+also flattened in Fortran order. Each row holds one entry per detector,
+with the angular weight as value, in detector order. A stack of z steps
+is then reconstructed with a single sparse x dense-matrix product,
+which reads the geometry once for all z steps of the stack and sums
+every pixel in the same order as recon_loop.
+"""
+
+import numpy as np
+from scipy import sparse
+
+
+def backprojection_matrix(idxAll, angularWeight, nSamples):
+  """CSR matrix of the backprojection described by the tables returned
+  by find_index_map_and_angular_weight, for A-lines of nSamples samples
+  """
+  (nPixely, nPixelx, nSteps) = idxAll.shape
+  nPixels = nPixely * nPixelx
+  nCols = nSamples * nSteps
+  indexType = np.int32 if nCols < np.iinfo(np.int32).max else np.int64
+  # same addressing as recon_loop: idx + nSamples * detector - 1
+  indices = idxAll.reshape((nPixels, nSteps), order='F').astype(indexType)
+  indices += (np.arange(nSteps, dtype=indexType) * nSamples - 1)
+  np.maximum(indices, 0, out=indices)
+  data = np.asarray(angularWeight.reshape((nPixels, nSteps), order='F'),
+                    dtype=np.double)
+  indptr = np.arange(0, nPixels * nSteps + 1, nSteps, dtype=indexType)
+  return sparse.csr_matrix((data.ravel(), indices.ravel(), indptr),
+                           shape=(nPixels, nCols))
+
+
+class BackprojectionOperator:
+  """reusable backprojection of stacks of z steps
+  matrix: CSR matrix returned by backprojection_matrix
+  totalAngularWeight: normalization image returned by
+                      find_index_map_and_angular_weight
+  """
+  def __init__(self, matrix, totalAngularWeight):
+    self.matrix = matrix
+    self.totalAngularWeight = totalAngularWeight
+    (self.nPixely, self.nPixelx) = totalAngularWeight.shape
+
+  def arrays(self):
+    """(data, indices, indptr, totalAngularWeight), e.g. for caching"""
+    return (self.matrix.data, self.matrix.indices, self.matrix.indptr,
+            self.totalAngularWeight)
+
+  def apply(self, paData, out=None):
+    """reconstruct every z step of paData, a (nSamples, nSteps, zSteps)
+    array of DC-removed A-lines, into out (a new Fortran-ordered
+    (nPixely, nPixelx, zSteps) array by default). The result equals
+    recon_loop(paData[:,:,z], ...) / totalAngularWeight for each z.
+    """
+    (nSamples, nSteps, zSteps) = paData.shape
+    # one column per z step
+    aLines = np.ascontiguousarray(
+        np.reshape(paData, (nSamples * nSteps, zSteps), order='F'),
+        dtype=np.double)
+    pixels = self.matrix.dot(aLines)
+    if out is None:
+      out = np.zeros((self.nPixely, self.nPixelx, zSteps), order='F')
+    for z in range(zSteps):
+      out[:, :, z] = pixels[:, z].reshape((self.nPixely, self.nPixelx),
+                                          order='F')
+    out /= self.totalAngularWeight[:, :, np.newaxis]
+    return out
+
+
+def operator_from_arrays(arrays, nSamples, nSteps):
+  """rebuild a BackprojectionOperator from the output of arrays()"""
+  (data, indices, indptr, totalAngularWeight) = arrays
+  matrix = sparse.csr_matrix((data, indices, indptr),
+                             shape=(len(indptr) - 1, nSamples * nSteps))
+  return BackprojectionOperator(matrix, totalAngularWeight)
+
+
+def operator_from_tables(idxAll, angularWeight, totalAngularWeight,
+                         nSamples):
+  """BackprojectionOperator of find_index_map_and_angular_weight tables"""
+  return BackprojectionOperator(
+      backprojection_matrix(idxAll, angularWeight, nSamples),
+      totalAngularWeight)
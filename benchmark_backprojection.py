@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# benchmark_backprojection.py
+"""compare delay-and-sum and hierarchical backprojection on synthetic
+point sources, over image sizes, to find where the hierarchical engine
+becomes faster and how accurate it is"""
+
+import argh
+import numpy as np
+from time import time
+from recon_loop import recon_on_the_fly
+from hierarchical_backprojection import HierarchicalBackprojector
+
+N_STEPS = 512
+N_SAMPLES = 1300
+# center frequency of the synthetic pulses (MHz)
+PULSE_FREQUENCY = 5.0
+
+
+def synthetic_data(xReceive, yReceive, delayIdx, vm, fs, fov, nSources=20):
+  """A-lines of random point sources within the field of view"""
+  rng = np.random.RandomState(0)
+  sources = (rng.rand(nSources, 2) - 0.5) * fov
+  t = np.arange(1, N_SAMPLES + 1, dtype=np.double)
+  paData = np.zeros((N_SAMPLES, N_STEPS), order='F')
+  for (xs, ys) in sources:
+    dist = np.hypot(xReceive - xs, yReceive - ys)
+    center = (dist / vm - delayIdx) * fs
+    # gaussian-modulated sine of PULSE_FREQUENCY
+    offset = (t[:, np.newaxis] - center) / fs
+    paData += np.sin(2 * np.pi * PULSE_FREQUENCY * offset) *\
+        np.exp(-np.square(offset * PULSE_FREQUENCY) / 2)
+  return paData
+
+
+def geometry(fov, rf, R=25.0, iniAngle=225.0):
+  nPixel = int(round(fov * rf))
+  axis = (np.arange(1, nPixel + 1, dtype=np.double) - nPixel / 2)\
+      * fov / nPixel
+  xImg = np.asfortranarray(np.tile(axis, (nPixel, 1)))
+  yImg = np.asfortranarray(np.tile(axis[::-1, np.newaxis], (1, nPixel)))
+  angle = np.arange(N_STEPS) * 2 * np.pi / N_STEPS + iniAngle / 180 * np.pi
+  return xImg, yImg, np.cos(angle) * R, np.sin(angle) * R
+
+
+@argh.arg('-f', '--fov', type=float, help='field of view (mm)')
+@argh.arg('-r', '--resolution-factors', type=int, nargs='+',
+          help='pixels per mm of the image sizes to compare')
+@argh.arg('-o', '--oversampling', type=float, nargs='+',
+          help='oversampling factors of the hierarchical engine')
+@argh.arg('-t', '--threads', type=int,
+          help='threads of the delay-and-sum engine')
+@argh.arg('-z', '--z-steps', type=int,
+          help='z steps reconstructed at once by both engines')
+def main(fov=20.0, resolution_factors=[5, 10, 20, 40],
+         oversampling=[1.0, 2.0], threads=1, z_steps=4):
+  vm = 1.51
+  fs = 40.0
+  delayIdx = -np.ones(N_STEPS) * 18 / fs
+  print('%8s %5s %9s %9s %9s %9s %9s'
+        % ('pixels', 'ovs', 'das (s)', 'setup (s)', 'hier (s)',
+           'speed-up', 'rms error'))
+  crossover = {}
+  for rf in resolution_factors:
+    xImg, yImg, xReceive, yReceive = geometry(fov, rf)
+    paData = synthetic_data(xReceive, yReceive, delayIdx, vm, fs, fov)
+    paBlock = np.asfortranarray(np.repeat(paData[:, :, np.newaxis],
+                                          z_steps, axis=2))
+    st = time()
+    dasImg, dasWeight = recon_on_the_fly(paBlock, xImg, yImg, xReceive,
+                                         yReceive, delayIdx, vm, fs,
+                                         threads)
+    dasTime = (time() - st) / z_steps
+    dasImg = dasImg[:, :, 0] / dasWeight
+    for ovs in oversampling:
+      st = time()
+      hier = HierarchicalBackprojector(xImg, yImg, xReceive, yReceive,
+                                       delayIdx, vm, fs, N_SAMPLES, ovs)
+      setupTime = time() - st
+      st = time()
+      hierImg = hier.apply(paBlock)[:, :, 0]
+      hierTime = (time() - st) / z_steps
+      # RMS difference relative to the peak of the image
+      error = np.sqrt(np.mean(np.square(hierImg - dasImg)))\
+          / np.abs(dasImg).max()
+      print('%8d %5.1f %9.3f %9.3f %9.3f %9.2f %9.4f'
+            % (xImg.size, ovs, dasTime, setupTime, hierTime,
+               dasTime / hierTime, error))
+      if hierTime < dasTime and ovs not in crossover:
+        crossover[ovs] = xImg.size
+  # the setup, like the geometry tables, is shared by all z steps
+  for ovs in oversampling:
+    if ovs in crossover:
+      print('oversampling %.1f: hierarchical is faster per z step from '
+            '%d pixels' % (ovs, crossover[ovs]))
+    else:
+      print('oversampling %.1f: no crossover in the tested sizes' % ovs)
+
+if __name__ == '__main__':
+  argh.dispatch_command(main)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# benchmark_focal_line.py
+"""compare submitting A-lines one at a time and a z step at a time to
+the focal-line backends of reconstruct_unpacked_3d, on synthetic data"""
+
+import argh
+import numpy as np
+from time import time
+from reconstruct_unpacked_3d import create_focal_line_backend,\
+    backproject_planes, cuda_context
+
+N_STEPS = 512
+N_SAMPLES = 1300
+
+
+def synthetic_scan(nPixels, zSteps, numGroup):
+    """geometry and random A-lines of a scan of zSteps z steps, rearranged
+    into numGroup firing groups"""
+    rng = np.random.RandomState(0)
+    lenR, vm, fs, R = 38.0, 1.51, 40.0, 50.0
+    axis = np.linspace(-5, 5, nPixels).astype(np.float32)
+    angle = (np.arange(N_STEPS) * 2 * np.pi / N_STEPS).astype(np.float32)
+    geometry = (axis, axis[::-1].copy(), (axis + 1.0).astype(np.float32),
+                np.cos(angle) * np.float32(R), np.sin(angle) * np.float32(R),
+                np.zeros(N_STEPS, dtype=np.float32), lenR, vm, fs)
+    nLines = N_STEPS // numGroup
+    paData = np.asfortranarray(rng.randn(N_SAMPLES, nLines,
+                                         zSteps * numGroup),
+                               dtype=np.float32)
+    pulseList = np.arange(N_STEPS).reshape((numGroup, nLines), order='F')
+    zReceive = (np.arange(zSteps * numGroup) * 0.1 / numGroup)\
+        .astype(np.float32)
+    return geometry, paData, pulseList, zReceive
+
+
+def run(ctx, nPixels, geometry, paData, pulseList, zReceive, planesPerCall,
+        linesPerCall, threads):
+    """seconds taken by backproject_planes with planesPerCall planes, or
+    by single line submissions if linesPerCall is 1, and the image"""
+    reImg = np.zeros((nPixels, nPixels, nPixels), dtype=np.float32)
+    backend = create_focal_line_backend(ctx, reImg, *(geometry +
+                                                      (threads,)))
+    quiet = lambda current, total, t: None
+    st = time()
+    if linesPerCall == 1:
+        numGroup, nLines = pulseList.shape
+        for zi in range(paData.shape[2]):
+            for li in range(nLines):
+                backend.backproject(
+                    np.asfortranarray(paData[:, li:li + 1, zi:zi + 1]),
+                    zReceive[zi:zi + 1],
+                    np.array([[pulseList[zi % numGroup, li]]],
+                             dtype=np.int32))
+        reImg = backend.result()
+    else:
+        reImg = backproject_planes(backend, paData, zReceive, pulseList,
+                                   planesPerCall, quiet)
+    return time() - st, reImg
+
+
+@argh.arg('-n', '--n-pixels', type=int, help='pixels along x, y and z')
+@argh.arg('-z', '--z-steps', type=int, help='z steps of the scan')
+@argh.arg('-g', '--groups', type=int, help='firing groups')
+@argh.arg('-t', '--threads', type=int, help='threads of the CPU backend')
+@argh.arg('-r', '--repeats', type=int, help='runs per mode, the best counts')
+def main(n_pixels=48, z_steps=4, groups=8, threads=1, repeats=3):
+    geometry, paData, pulseList, zReceive =\
+        synthetic_scan(n_pixels, z_steps, groups)
+    backends = [('cpu', None)]
+    try:
+        backends.append(('cuda', cuda_context()))
+    except Exception:
+        print('cuda: not available')
+    for name, ctx in backends:
+        lineRuns = [run(ctx, n_pixels, geometry, paData, pulseList,
+                        zReceive, 1, 1, threads) for i in range(repeats)]
+        stepRuns = [run(ctx, n_pixels, geometry, paData, pulseList,
+                        zReceive, groups, None, threads)
+                    for i in range(repeats)]
+        lineTime, lineImg = min(lineRuns, key=lambda r: r[0])
+        stepTime, stepImg = min(stepRuns, key=lambda r: r[0])
+        print('{}: per line {:.3f} s, per z step {:.3f} s, speed-up {:.2f}, '
+              'identical {}'.format(name, lineTime, stepTime,
+                                    lineTime / stepTime,
+                                    np.array_equal(lineImg, stepImg)))
+        if ctx is not None:
+            ctx.pop()
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
@@ -45,14 +45,18 @@ class UnpackThread(QtCore.QThread):
 class ReconstructThread(QtCore.QThread):
   '''the thread class for reconstruct function'''
   reconstructProgressSignal = QtCore.pyqtSignal(int, int)
+  reconstructPreviewSignal = QtCore.pyqtSignal(object, int, int)
   def __init__(self, opts):
     QtCore.QThread.__init__(self)
     self.opts = opts
     self.reImg = None
   def progressHandler(self, current, total):
     self.reconstructProgressSignal.emit(current, total)
+  def previewHandler(self, image, stage, nStages):
+    self.reconstructPreviewSignal.emit(image, stage, nStages)
   def run(self):
-    self.reImg = reconstruct_2d(self.opts, progress=self.progressHandler)
+    self.reImg = reconstruct_2d(self.opts, progress=self.progressHandler,
+                                preview=self.previewHandler)
 
 class Reconstruct3DThread(QtCore.QThread):
   '''the thread class for reconstruct 3d function'''
@@ -105,6 +109,8 @@ class ConfigDialog(QtGui.QDialog):
     self.reconstructThread.finished.connect(self.reconThreadFinished)
     self.reconstructThread.reconstructProgressSignal.connect\
         (self.updateProgress)
+    self.reconstructThread.reconstructPreviewSignal.connect\
+        (self.showPreview)
     self.reconstruct3DThread.terminated.connect(self.workThreadTerminated)
     self.reconstruct3DThread.finished.connect(self.recon3dThreadFinished)
     self.reconstruct3DThread.reconstruct3dProgressSignal.connect\
@@ -125,9 +131,20 @@ class ConfigDialog(QtGui.QDialog):
     img = self.reconstructThread.reImg.astype('float32')
     self.ui.mImageDisplay.setInput(img)
 
+  @QtCore.pyqtSlot(object, int, int)
+  def showPreview(self, image, stage, nStages):
+    # the last stage is the full image, shown when the thread finishes
+    if stage < nStages:
+      self.logText('Preview {:d}/{:d}\n'.format(stage, nStages - 1))
+      self.ui.mImageDisplay.setInput(image.astype('float32'))
+
   @QtCore.pyqtSlot()
   def recon3dThreadFinished(self):
     self.logText('Done\n')
+    if self.reconstruct3DThread.reImg is None:
+      # reconstructed out of core, the volume is only on disk
+      self.logText('Volume saved to reImg_*_3d.h5\n')
+      return
     # show image
     img = self.reconstruct3DThread.reImg.astype('float32')
     self.ui.mImageDisplay.setInput(img)
@@ -165,6 +182,7 @@ class ConfigDialog(QtGui.QDialog):
     self.opts['extra']['dest_dir'] =\
         normpath(self.opts['extra']['src_dir'] + '/unpack')
     self.opts['extra']['dtype'] = r'<u4'
+    self.opts['extra']['use_mmap'] = self.ui.mChkMmap.isChecked()
     # load section
     self.opts['load']['EXP_START'] = int(self.ui.mEditInputIndex.text())
     self.opts['load']['EXP_END'] = int(self.ui.mEditInputIndex.text())
@@ -197,10 +215,9 @@ class ConfigDialog(QtGui.QDialog):
     #self.opts['display']['denoise'] = self.ui.mChkDenoise.isChecked()
     self.opts['display']['denoise'] = False
     # recon section
-    algorithms = ['delay-and-sum', 'envelope']
-    #self.opts['recon']['algorithm'] =\
-        #algorithms[self.ui.mCmbAlgorithm.currentIndex()]
-    self.opts['recon']['algorithm'] = 'delay-and-sum'
+    algorithms = ['delay-and-sum', 'envelope', 'hierarchical']
+    self.opts['recon']['algorithm'] =\
+        algorithms[self.ui.mCmbAlgorithm.currentIndex()]
     self.opts['recon']['V_M'] = self.ui.mSpnVm.value()
     self.opts['recon']['ini_angle'] = self.ui.mSpnInitAngle.value()
     self.opts['recon']['x_size'] = self.ui.mSpnXSize.value()
@@ -0,0 +1,299 @@
+"""
+daq_decode module that interprets raw DAQ pack data into channel data.
+
+This is a vectorized, shape-generic counterpart of daq_loop in
+unpack_speedup.pyx. Geometry (DataBlockSize, NumElements, TotFirings,
+NumDaqChnsBoard) is taken from the 'unpack' section of the options and
+any number of boards is accepted. Boards and ranges of experiments are
+decoded concurrently on a thread pool, with the compiled
+daq_decode_range kernel (which releases the GIL) when unpack_speedup is
+built, or with NumPy otherwise.
+"""
+
+import os
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+try:
+  from unpack_speedup import daq_decode_range
+except ImportError:
+  daq_decode_range = None
+
+# every 32-bit word of a pack carries up to three 10-bit samples, and
+# each firing of a board is spread over 6 pack columns. Two consecutive
+# words belong to two different channels, so columns carry 6, 6, 4, 6,
+# 6 and 4 channels respectively (32 channels per board).
+PACK_FIELD_COUNTS = (6, 6, 4, 6, 6, 4)
+PACKS_PER_FIRING = len(PACK_FIELD_COUNTS)
+FIELD_MASK = 0x3ff
+# number of experiments decoded at a time, to bound temporary buffers
+EXP_CHUNK = 8
+
+
+def pack_field_table():
+  """return (column, word, shift) arrays of each DAQ channel of a board,
+  where column is the pack column within a firing, word is 0 for even
+  rows and 1 for odd rows and shift is the bit offset of the field
+  """
+  columns = []
+  words = []
+  shifts = []
+  for col, count in enumerate(PACK_FIELD_COUNTS):
+    for f in range(count):
+      columns.append(col)
+      words.append(f % 2)
+      shifts.append(10 * (f // 2))
+  return (np.array(columns, dtype=np.intp),
+          np.array(words, dtype=np.intp),
+          np.array(shifts, dtype=np.uint32))
+
+
+def board_words(packData, dataBlockSize, totFirings, numExpr):
+  """view one board's pack data as
+  (numExpr, PACKS_PER_FIRING, 2, totFirings, dataBlockSize)
+  packData is laid out as daq_loop expects it, i.e. (sample words,
+  pack columns), and only its first 2*dataBlockSize rows are used
+  """
+  words = packData[0:2 * dataBlockSize, :].T
+  words = words.reshape((numExpr, totFirings, PACKS_PER_FIRING,
+                         dataBlockSize, 2))
+  return words.transpose(0, 2, 4, 1, 3)
+
+
+def board_plan(destChannels, totFirings):
+  """group the (DAQ channel, firing) pairs of one board by runs of
+  consecutive destination elements
+  destChannels: 0-based element index of each (DAQ channel, firing),
+                in the order of the channel map
+  returns a list of (first element, last element + 1, column, word,
+  firing, shift), the last four being index arrays along the run
+  """
+  columns, parity, shifts = pack_field_table()
+  order = np.argsort(destChannels, kind='mergesort')
+  dest = destChannels[order]
+  breaks = np.nonzero(np.diff(dest) != 1)[0] + 1
+  plan = []
+  for run in np.split(np.arange(dest.size), breaks):
+    src = order[run]
+    chn = src // totFirings
+    plan.append((int(dest[run[0]]), int(dest[run[-1]]) + 1,
+                 columns[chn], parity[chn], src % totFirings,
+                 shifts[chn].reshape((-1, 1))))
+  return plan
+
+
+def decode_board(words, plan, numElements, out, expStart, expEnd,
+                 acc=None):
+  """decode experiments [expStart, expEnd) of one board into out
+  words: view returned by board_words (or a slice of it along the first
+         axis, experiments being counted from the start of the slice)
+  plan: list returned by board_plan
+  out: C-ordered (numExpr, numElements, dataBlockSize) array, which is
+       the transposed view of chndata_all
+  acc: optional (numElements, dataBlockSize) array, the transposed view
+       of chndata, from which the experiments are subtracted in order
+  bit-unpacking, DC removal, scaling and the channel permutation are
+  applied in one pass over each chunk of experiments, writing straight
+  into out
+  """
+  dataBlockSize = words.shape[4]
+  for n0 in range(expStart, expEnd, EXP_CHUNK):
+    n1 = min(n0 + EXP_CHUNK, expEnd)
+    for (e0, e1, column, parity, firing, shift) in plan:
+      # fields has shape (experiments, elements, samples)
+      fields = words[n0:n1, column, parity, firing] >> shift
+      fields &= FIELD_MASK
+      # sums of 10-bit integers are exact, so is the mean
+      meanData = fields.sum(axis=2, dtype=np.uint64) / float(dataBlockSize)
+      target = out[n0:n1, e0:e1, :]
+      np.subtract(fields, meanData[:, :, np.newaxis], out=target)
+      # same as negating (raw - mean) / numElements
+      target /= -float(numElements)
+      if acc is not None:
+        for n in range(n1 - n0):
+          acc[e0:e1] -= target[n]
+
+
+_threadPools = {}
+
+def thread_pool(numThreads):
+  """return a shared pool of numThreads threads (one set per process)"""
+  key = (os.getpid(), numThreads)
+  if not key in _threadPools:
+    _threadPools[key] = ThreadPool(numThreads)
+  return _threadPools[key]
+
+
+class PackDecoder:
+  """decoder of the pack data of all boards of one index
+  Work is split into (board, chunk of EXP_CHUNK experiments) tasks that
+  run on numThreads threads (0 for one per CPU).
+  """
+  def __init__(self, packData, chanMap, numExpr, unpackOpts, numThreads=1):
+    self.dataBlockSize = unpackOpts['DataBlockSize']
+    self.numElements = unpackOpts['NumElements']
+    self.totFirings = unpackOpts['TotFirings']
+    numDaqChnsBoard = unpackOpts['NumDaqChnsBoard']
+    assert numDaqChnsBoard == sum(PACK_FIELD_COUNTS)
+    chnsPerBoard = numDaqChnsBoard * self.totFirings
+    assert len(packData) * chnsPerBoard <= self.numElements
+    self.numExpr = numExpr
+    if numThreads == 0:
+      numThreads = multiprocessing.cpu_count()
+    self.numThreads = numThreads
+    self.table = pack_field_table()
+    self.packData = []
+    self.destChannels = []
+    self.words = []
+    self.plans = []
+    for boardId, boardData in enumerate(packData):
+      boardData = boardData[0:2 * self.dataBlockSize, :]
+      destChannels = chanMap[boardId * chnsPerBoard:
+                             (boardId + 1) * chnsPerBoard].astype(np.intp) - 1
+      self.packData.append(boardData)
+      self.destChannels.append(destChannels)
+      if daq_decode_range == None:
+        self.words.append(board_words(boardData, self.dataBlockSize,
+                                      self.totFirings, numExpr))
+        self.plans.append(board_plan(destChannels, self.totFirings))
+
+  def decode_task(self, task):
+    boardId, out, n0, n1, outStart, firings, acc = task
+    if daq_decode_range != None:
+      columns, parity, shifts = self.table
+      daq_decode_range(self.packData[boardId], self.destChannels[boardId],
+                       columns, parity, shifts, out, n0, n1, outStart,
+                       self.totFirings, self.numElements, firings, acc)
+    else:
+      decode_board(self.words[boardId][n0:n1], self.plans[boardId],
+                   self.numElements, out[n0 - outStart:n1 - outStart],
+                   0, n1 - n0, acc)
+
+  def decode(self, out, expStart, expEnd, acc=None):
+    """decode experiments [expStart, expEnd) of all boards into out, a
+    C-ordered (expEnd - expStart, NumElements, DataBlockSize) array
+    acc: optional (NumElements, DataBlockSize) array from which the
+         experiments are subtracted in order while they are decoded
+    """
+    nBoards = len(self.packData)
+    if acc is None:
+      tasks = [(boardId, out, n0, min(n0 + EXP_CHUNK, expEnd), expStart,
+                None, None)
+               for boardId in range(nBoards)
+               for n0 in range(expStart, expEnd, EXP_CHUNK)]
+    elif daq_decode_range != None:
+      # firings of a board write disjoint elements, so each task can run
+      # over all experiments in order
+      tasks = [(boardId, out, expStart, expEnd, expStart, (f, f + 1), acc)
+               for boardId in range(nBoards)
+               for f in range(self.totFirings)]
+    else:
+      tasks = [(boardId, out, expStart, expEnd, expStart, None, acc)
+               for boardId in range(nBoards)]
+    if self.numThreads > 1 and len(tasks) > 1:
+      thread_pool(self.numThreads).map(self.decode_task, tasks)
+    else:
+      for task in tasks:
+        self.decode_task(task)
+
+
+def daq_decode(packData, chanMap, numExpr, unpackOpts, numThreads=1):
+  """drop-in replacement of daq_loop
+  packData: list of per-board pack data, each as passed to daq_loop
+  chanMap: channel map returned by generateChanMap
+  numExpr: number of experiments (z steps)
+  unpackOpts: 'unpack' section of the options
+  numThreads: number of decoding threads, 0 for one per CPU
+  returns chndata and chndata_all, identical to those of daq_loop
+  """
+  decoder = PackDecoder(packData, chanMap, numExpr, unpackOpts, numThreads)
+  dataBlockSize = decoder.dataBlockSize
+  numElements = decoder.numElements
+  chndata_all = np.zeros((dataBlockSize, numExpr * numElements),
+                         dtype=np.double, order='F')
+  out = chndata_all.T.reshape((numExpr, numElements, dataBlockSize))
+  # accumulated over experiments in order while decoding, as daq_loop
+  # does
+  chndata = np.zeros((dataBlockSize, numElements),
+                     dtype=np.double, order='F')
+  decoder.decode(out, 0, numExpr, chndata.T)
+  return chndata, chndata_all
+
+
+class LazyChannelData:
+  """array-like stand-in for chndata_all that keeps the packed pack data
+  (typically memory-mapped) and decodes experiments on demand
+  Indexing follows chndata_all, i.e. [sample, element, z step], and only
+  the z steps selected by the last index are decoded. Bad channels are
+  flipped the same way as in unpack_data.unpack_index.
+  """
+  def __init__(self, packData, chanMap, numExpr, unpackOpts, numThreads=1):
+    self.decoder = PackDecoder(packData, chanMap, numExpr, unpackOpts,
+                               numThreads)
+    self.dataBlockSize = self.decoder.dataBlockSize
+    self.numElements = self.decoder.numElements
+    self.numExpr = numExpr
+    self.badChannels =\
+        [(chnInd - 1) for chnInd in unpackOpts['BadChannels']]
+    self.shape = (self.dataBlockSize, self.numElements, numExpr)
+    self.ndim = 3
+    self.dtype = np.dtype(np.double)
+
+  def __len__(self):
+    return self.shape[0]
+
+  def set_threads(self, numThreads):
+    """decode on numThreads threads from now on"""
+    self.decoder.numThreads = numThreads
+
+  def decode(self, expStart, expEnd):
+    """decode experiments [expStart, expEnd) as a Fortran-ordered
+    (DataBlockSize, NumElements, expEnd - expStart) array"""
+    numExpr = expEnd - expStart
+    out = np.zeros((numExpr, self.numElements, self.dataBlockSize))
+    self.decoder.decode(out, expStart, expEnd)
+    out[:, self.badChannels, :] = -out[:, self.badChannels, :]
+    return out.T
+
+  def __getitem__(self, key):
+    if not isinstance(key, tuple):
+      key = (key,)
+    key = key + (slice(None),) * (3 - len(key))
+    zKey = key[2]
+    if isinstance(zKey, slice):
+      start, stop, step = zKey.indices(self.numExpr)
+      if step == 1:
+        return self.decode(start, max(start, stop))[key[0], key[1], :]
+      zKey = range(start, stop, step)
+    if np.ndim(zKey) == 0:
+      z = int(zKey)
+      if z < 0:
+        z += self.numExpr
+      if z < 0 or z >= self.numExpr:
+        raise IndexError('z step index out of range')
+      return self.decode(z, z + 1)[key[0], key[1], 0]
+    data = np.zeros((self.dataBlockSize, self.numElements, len(zKey)),
+                    order='F')
+    for zi, z in enumerate(zKey):
+      data[:, :, zi] = self[:, :, z]
+    return data[key[0], key[1], :]
+
+  def __array__(self, dtype=None):
+    data = self.decode(0, self.numExpr)
+    if dtype != None:
+      data = data.astype(dtype)
+    return data
+
+  def iter_z(self, zChunk=EXP_CHUNK):
+    """yield (first z step, chunk of decoded z steps) over the data"""
+    for z0 in range(0, self.numExpr, zChunk):
+      yield z0, self.decode(z0, min(z0 + zChunk, self.numExpr))
+
+  def average(self):
+    """average over z steps, same as chndata of unpack_index"""
+    chnSum = np.zeros((self.dataBlockSize, self.numElements), order='F')
+    for z0, data in self.iter_z():
+      for z in range(data.shape[2]):
+        chnSum += data[:, :, z]
+    return chnSum / self.numExpr
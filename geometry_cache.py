@@ -0,0 +1,247 @@
+"""
+geometry_cache module that keeps the backprojection geometry tables
+(idxAll, angularWeight, totalAngularWeight) returned by
+find_index_map_and_angular_weight, so that datasets reconstructed with
+the same settings do not recompute them.
+
+Tables are keyed by a hash of everything they depend on (image grid,
+receiver positions, delay vector, V_M, fs and number of samples). They
+are kept in memory with LRU eviction under a size budget and, if a
+cache folder is given, as geometry_<key>.h5 files in that folder, with
+LRU eviction under a separate size budget. The sparse backprojection
+operators built from the tables are cached the same way.
+"""
+
+import os
+import glob
+import hashlib
+import tempfile
+from collections import OrderedDict
+import numpy as np
+import h5py
+from pact_helpers import notifyCli
+from recon_loop import find_index_map_and_angular_weight
+from backprojection import operator_from_arrays, operator_from_tables
+
+# bump when the content of the tables changes for the same inputs
+CACHE_VERSION = 1
+TABLE_NAMES = ('idxAll', 'angularWeight', 'totalAngularWeight')
+OPERATOR_NAMES = ('data', 'indices', 'indptr', 'totalAngularWeight')
+
+
+def quantize_delay(delayIdx, fs, step):
+  """round delayIdx (in us) to multiples of step samples, so that
+  calibrations differing by less than that share a cache entry"""
+  if not step:
+    return delayIdx
+  return np.round(delayIdx * fs / step) * step / fs
+
+
+def table_dtypes(reconOpts, nSamples):
+  """data types of idxAll and angularWeight set by recon.index_dtype
+  (auto, uint16, uint32 or uint64) and recon.weight_dtype (float32 or
+  float64). auto picks the narrowest type holding indices up to nSamples
+  """
+  idxDtype = reconOpts.get('index_dtype', 'auto')
+  if idxDtype == 'auto':
+    idxDtype = np.uint16 if nSamples <= np.iinfo(np.uint16).max\
+        else np.uint32
+  idxDtype = np.dtype(idxDtype)
+  assert np.iinfo(idxDtype).max >= nSamples
+  weightDtype = np.dtype(reconOpts.get('weight_dtype', 'float64'))
+  return idxDtype, weightDtype
+
+
+def geometry_key(*args):
+  """content hash of arrays and scalars"""
+  h = hashlib.sha1('geometry-v' + str(CACHE_VERSION))
+  for arg in args:
+    if isinstance(arg, np.ndarray):
+      arg = np.ascontiguousarray(arg)
+      h.update(str(arg.dtype) + str(arg.shape))
+      h.update(arg.data)
+    else:
+      h.update(repr(arg))
+  return h.hexdigest()
+
+
+class GeometryCache:
+  """LRU cache of geometry tables in memory, backed by an optional
+  folder of HDF5 files holding up to maxDiskBytes"""
+  def __init__(self, cacheDir=None, maxBytes=2048 * 1024 * 1024,
+               maxDiskBytes=4096 * 1024 * 1024):
+    self.cacheDir = cacheDir
+    self.maxBytes = maxBytes
+    self.maxDiskBytes = maxDiskBytes
+    self.entries = OrderedDict()
+    self.nbytes = 0
+
+  def file_path(self, key):
+    return os.path.join(self.cacheDir, 'geometry_' + key + '.h5')
+
+  def get(self, key, names=TABLE_NAMES):
+    """return cached tables or None
+    names: names of the tables in the HDF5 file"""
+    if key in self.entries:
+      tables = self.entries.pop(key)
+      self.entries[key] = tables
+      return tables
+    if self.cacheDir and os.path.isfile(self.file_path(key)):
+      f = h5py.File(self.file_path(key), 'r')
+      tables = tuple([np.array(f[name], order='F') for name in names])
+      f.close()
+      # the modification time orders files for eviction
+      os.utime(self.file_path(key), None)
+      self.remember(key, tables)
+      return tables
+    return None
+
+  def remember(self, key, tables):
+    """keep tables in memory, evicting the least recently used ones"""
+    size = sum([t.nbytes for t in tables])
+    if size > self.maxBytes:
+      notifyCli('Warning: backprojection tables of ' +
+                str(size // (1024 * 1024)) + ' MB exceed the ' +
+                str(self.maxBytes // (1024 * 1024)) +
+                ' MB geometry cache and are not kept in memory')
+      return
+    while self.entries and self.nbytes + size > self.maxBytes:
+      oldKey, oldTables = self.entries.popitem(last=False)
+      self.nbytes -= sum([t.nbytes for t in oldTables])
+    self.entries[key] = tables
+    self.nbytes += size
+
+  def put(self, key, tables, names=TABLE_NAMES):
+    """store tables in memory and on disk"""
+    self.remember(key, tables)
+    size = sum([t.nbytes for t in tables])
+    if not self.cacheDir or size > self.maxDiskBytes:
+      return
+    self.evict_files(self.maxDiskBytes - size)
+    if not os.path.exists(self.cacheDir):
+      os.makedirs(self.cacheDir)
+    # write to a temporary file first so readers never see partial files
+    fd, tempPath = tempfile.mkstemp(suffix='.h5', dir=self.cacheDir)
+    os.close(fd)
+    f = h5py.File(tempPath, 'w')
+    for name, table in zip(names, tables):
+      f[name] = table
+    f.close()
+    os.rename(tempPath, self.file_path(key))
+
+  def evict_files(self, maxBytes):
+    """delete the least recently used files until the folder holds at
+    most maxBytes"""
+    paths = glob.glob(os.path.join(self.cacheDir, 'geometry_*.h5'))
+    files = []
+    for path in paths:
+      try:
+        files.append((os.path.getmtime(path), os.path.getsize(path), path))
+      except OSError:
+        # removed by another process
+        pass
+    total = sum([size for (mtime, size, path) in files])
+    for (mtime, size, path) in sorted(files):
+      if total <= maxBytes:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      total -= size
+
+  def clear(self):
+    """forget tables kept in memory"""
+    self.entries.clear()
+    self.nbytes = 0
+
+
+_caches = {}
+
+def get_geometry_cache(reconOpts):
+  """shared GeometryCache configured by the recon options
+  geometry_cache_dir: folder of cached tables, empty for memory only
+  geometry_cache_mb: memory budget of the cache in MB, -1 for the
+    table_memory_mb budget of the tables themselves
+  geometry_cache_disk_mb: size budget of the folder in MB
+  """
+  cacheDir = reconOpts.get('geometry_cache_dir', '')
+  if cacheDir:
+    cacheDir = os.path.expanduser(os.path.normpath(cacheDir))
+  cacheMb = reconOpts.get('geometry_cache_mb', -1)
+  if cacheMb < 0:
+    cacheMb = reconOpts.get('table_memory_mb', 2048)
+  maxBytes = int(cacheMb * 1024 * 1024)
+  maxDiskBytes = int(reconOpts.get('geometry_cache_disk_mb', 4096)
+                     * 1024 * 1024)
+  key = (cacheDir, maxBytes, maxDiskBytes)
+  if not key in _caches:
+    _caches[key] = GeometryCache(cacheDir, maxBytes, maxDiskBytes)
+  return _caches[key]
+
+
+def geometry_tables(key, nSteps, xImg, yImg, xReceive, yReceive,
+                    delayIdx, vm, fs, nSamples, idxDtype, weightDtype,
+                    cache, store=True):
+  """tables under key in cache, computed if missing
+  store: put computed tables in cache"""
+  tables = cache.get(key)
+  if tables != None:
+    notifyCli('Using cached backprojection parameters')
+    return tables
+  (idxAll, angularWeight, totalAngularWeight)\
+      = find_index_map_and_angular_weight\
+      (nSteps, xImg, yImg, xReceive, yReceive, delayIdx, vm, fs,
+       nSamples, idxDtype, weightDtype)
+  tables = (idxAll, angularWeight, totalAngularWeight)
+  if store:
+    cache.put(key, tables)
+  return tables
+
+
+def cached_index_map_and_angular_weight(nSteps, xImg, yImg, xReceive,
+                                        yReceive, delayIdx, vm, fs,
+                                        nSamples, reconOpts):
+  """find_index_map_and_angular_weight through the geometry cache
+  Indices beyond nSamples are set to 1, as reconstruction_inline does,
+  and table types follow table_dtypes. If recon.delay_quantization is
+  set, delayIdx is first rounded to multiples of that many samples. The
+  returned arrays are shared with the cache and must not be modified.
+  """
+  delayIdx = quantize_delay(delayIdx, fs,
+                            reconOpts.get('delay_quantization', 0))
+  idxDtype, weightDtype = table_dtypes(reconOpts, nSamples)
+  key = geometry_key(nSteps, xImg, yImg, xReceive, yReceive, delayIdx,
+                     float(vm), float(fs), nSamples, idxDtype.str,
+                     weightDtype.str)
+  return geometry_tables(key, nSteps, xImg, yImg, xReceive, yReceive,
+                         delayIdx, vm, fs, nSamples, idxDtype, weightDtype,
+                         get_geometry_cache(reconOpts))
+
+
+def cached_backprojection_operator(nSteps, xImg, yImg, xReceive, yReceive,
+                                   delayIdx, vm, fs, nSamples, reconOpts):
+  """BackprojectionOperator of the same geometry, through the geometry
+  cache (see cached_index_map_and_angular_weight)"""
+  delayIdx = quantize_delay(delayIdx, fs,
+                            reconOpts.get('delay_quantization', 0))
+  idxDtype, weightDtype = table_dtypes(reconOpts, nSamples)
+  cache = get_geometry_cache(reconOpts)
+  key = geometry_key(nSteps, xImg, yImg, xReceive, yReceive, delayIdx,
+                     float(vm), float(fs), nSamples, idxDtype.str,
+                     weightDtype.str)
+  operatorKey = geometry_key('operator', key)
+  arrays = cache.get(operatorKey, OPERATOR_NAMES)
+  if arrays != None:
+    notifyCli('Using cached backprojection operator')
+    return operator_from_arrays(arrays, nSamples, nSteps)
+  # tables cached by a loop reconstruction are reused, but the operator
+  # replaces them, so new tables are not cached
+  (idxAll, angularWeight, totalAngularWeight)\
+      = geometry_tables(key, nSteps, xImg, yImg, xReceive, yReceive,
+                        delayIdx, vm, fs, nSamples, idxDtype, weightDtype,
+                        cache, store=False)
+  operator = operator_from_tables(idxAll, angularWeight,
+                                  totalAngularWeight, nSamples)
+  cache.put(operatorKey, operator.arrays(), OPERATOR_NAMES)
+  return operator
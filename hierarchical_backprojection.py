@@ -0,0 +1,217 @@
+"""
+hierarchical_backprojection module, a multi-level approximation of the
+delay-and-sum backprojection of recon_loop.
+
+Detectors are merged pairwise into a binary tree of contiguous subsets.
+The partial image of each subset is sampled on a local polar grid
+(distance and angle around the middle of the subset on the ring). A
+single detector's partial image only varies along the distance, so its
+grid needs few angles, and the number of angles needed doubles with the
+aperture of the subset while the number of subsets halves, so every
+level costs about the same. The grid of a subset is filled by linear
+interpolation of the grids of its two halves; the image is finally
+interpolated from the grids of the top level subsets. The total cost is
+about O(N^2 log N) for N x N images and N detectors instead of O(N^3).
+
+oversampling sets the grid density relative to the sampling of the
+A-lines, i.e. the accuracy against delay-and-sum.
+"""
+
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+# fewest angles of a grid, which is enough for the angular weights
+MIN_ANGLES = 8
+# margin around the image, in grid steps, so that interpolation near the
+# border of the image stays within the grids
+GRID_MARGIN = 2
+
+
+class PolarGrid:
+  """polar grid around center, angles being measured from the direction
+  towards the ring center"""
+  def __init__(self, center, xBox, yBox, dRho, dPhi):
+    self.center = center
+    radius = np.hypot(center[0], center[1])
+    self.u = -center / radius
+    self.v = np.array([-self.u[1], self.u[0]])
+    # extent of the grid from points along the image border
+    rho, phi = self.local(xBox, yBox)
+    inside = (xBox.min() <= center[0] <= xBox.max() and
+              yBox.min() <= center[1] <= yBox.max())
+    rhoMin = 0.0 if inside else rho.min()
+    rhoMax = rho.max()
+    if inside or phi.max() - phi.min() > np.pi:
+      phiMin, phiMax = -np.pi, np.pi
+    else:
+      phiMin, phiMax = phi.min(), phi.max()
+    self.nRho = int(np.ceil((rhoMax - rhoMin) / dRho)) + 1 + 2 * GRID_MARGIN
+    self.rho0 = rhoMin - GRID_MARGIN * dRho
+    self.dRho = dRho
+    nPhi = int(np.ceil((phiMax - phiMin) / dPhi)) + 1
+    self.nPhi = max(nPhi, MIN_ANGLES) + 2 * GRID_MARGIN
+    self.dPhi = (phiMax - phiMin) / (self.nPhi - 1 - 2 * GRID_MARGIN)
+    self.phi0 = phiMin - GRID_MARGIN * self.dPhi
+
+  def local(self, x, y):
+    """(distance, angle) of points (x, y) around the center"""
+    dx = x - self.center[0]
+    dy = y - self.center[1]
+    along = dx * self.u[0] + dy * self.u[1]
+    across = dx * self.v[0] + dy * self.v[1]
+    return np.hypot(along, across), np.arctan2(across, along)
+
+  def axes(self):
+    return (self.rho0 + self.dRho * np.arange(self.nRho),
+            self.phi0 + self.dPhi * np.arange(self.nPhi))
+
+  def points(self):
+    """Cartesian coordinates of the grid points, (nRho, nPhi) each"""
+    rho, phi = self.axes()
+    along = rho[:, np.newaxis] * np.cos(phi)
+    across = rho[:, np.newaxis] * np.sin(phi)
+    return (self.center[0] + along * self.u[0] + across * self.v[0],
+            self.center[1] + along * self.u[1] + across * self.v[1])
+
+  def coordinates(self, x, y):
+    """fractional grid indices of points (x, y), for map_coordinates"""
+    rho, phi = self.local(x, y)
+    return np.array([(rho - self.rho0) / self.dRho,
+                     (phi - self.phi0) / self.dPhi])
+
+
+def interpolate(values, coords, out):
+  """add the linear interpolation of values (z steps, nRho, nPhi) at
+  coords to out (z steps, ...)"""
+  for z in range(values.shape[0]):
+    out[z] += map_coordinates(values[z], coords, order=1, mode='nearest')
+
+
+class HierarchicalBackprojector:
+  """hierarchical counterpart of find_index_map_and_angular_weight and
+  recon_loop (arguments are the same)
+  oversampling: grid density relative to the A-line sampling
+  levels: number of merge levels, None to choose it from the cost of
+          merging against the cost of interpolating the image
+  """
+  def __init__(self, xImg, yImg, xReceive, yReceive, delayIdx, vm, fs,
+               nSamples, oversampling=2.0, levels=None):
+    self.xImg = xImg
+    self.yImg = yImg
+    self.vm = vm
+    self.fs = fs
+    self.oversampling = oversampling
+    self.dRho = vm / fs / oversampling
+    self.detectors = np.array([xReceive, yReceive]).T
+    nSteps = len(xReceive)
+    nPixels = xImg.size
+    # points along the border of the image, with a margin
+    margin = GRID_MARGIN * self.dRho
+    xMin, xMax = xImg.min() - margin, xImg.max() + margin
+    yMin, yMax = yImg.min() - margin, yImg.max() + margin
+    edge = np.linspace(0.0, 1.0, 64)
+    self.xBox = np.concatenate([xMin + (xMax - xMin) * edge,
+                                np.full(64, xMax),
+                                xMax - (xMax - xMin) * edge,
+                                np.full(64, xMin)])
+    self.yBox = np.concatenate([np.full(64, yMin),
+                                yMin + (yMax - yMin) * edge,
+                                np.full(64, yMax),
+                                yMax - (yMax - yMin) * edge])
+    # tree of subsets: per level, list of ((first, last + 1), grid)
+    level = [((n, n + 1), self.subset_grid(n, n + 1))
+             for n in range(nSteps)]
+    self.levels = [level]
+    while len(level) > 1 and (levels == None or
+                              len(self.levels) <= levels):
+      parents = [(level[i][0][0], level[min(i + 1, len(level) - 1)][0][1])
+                 for i in range(0, len(level), 2)]
+      parentLevel = [((n0, n1), self.subset_grid(n0, n1))
+                     for (n0, n1) in parents]
+      if levels == None:
+        # stop when merging costs more than it saves on the image
+        mergeCost = sum([2 * grid.nRho * grid.nPhi
+                         for (subset, grid) in parentLevel])
+        if mergeCost >= (len(level) - len(parentLevel)) * nPixels:
+          break
+      self.levels.append(parentLevel)
+      level = parentLevel
+    # delay-and-sum samples and angular weights of each detector's grid
+    self.sampleIdx = []
+    self.weights = []
+    for ((n0, n1), grid) in self.levels[0]:
+      rho, phi = grid.axes()
+      idx = np.round((rho / vm - delayIdx[n0]) * fs)
+      idx[(idx < 0) | (idx > nSamples)] = 1
+      self.sampleIdx.append(np.maximum(idx.astype(np.intp) - 1, 0))
+      x, y = grid.points()
+      dx = x - xReceive[n0]
+      dy = y - yReceive[n0]
+      rr0 = np.hypot(dx, dy)
+      cosAlpha = np.abs((-xReceive[n0] * dx - yReceive[n0] * dy)
+                        / np.hypot(xReceive[n0], yReceive[n0]) / rr0)
+      cosAlpha = np.minimum(cosAlpha, 0.999)
+      self.weights.append(cosAlpha / np.square(rr0))
+    # grid indices of the pixels in the grids of the top level
+    self.imageCoords = [grid.coordinates(xImg, yImg)
+                        for (subset, grid) in self.levels[-1]]
+    # normalization image, from the same approximation
+    self.totalAngularWeight = self.backproject(None)[0]
+
+  def subset_grid(self, n0, n1):
+    """polar grid of the partial image of detectors [n0, n1)"""
+    members = self.detectors[n0:n1]
+    angle = np.arctan2(members[:, 1].sum(), members[:, 0].sum())
+    radius = np.hypot(members[:, 0], members[:, 1]).mean()
+    center = radius * np.array([np.cos(angle), np.sin(angle)])
+    aperture = 2 * np.hypot(members[:, 0] - center[0],
+                            members[:, 1] - center[1]).max()
+    # angles are sampled at the Nyquist rate of the path differences
+    # across the aperture
+    if aperture > 0:
+      dPhi = 2 * self.vm / (self.fs * aperture * self.oversampling)
+    else:
+      dPhi = np.inf
+    return PolarGrid(center, self.xBox, self.yBox, self.dRho, dPhi)
+
+  def subset_values(self, level, index, paData):
+    """partial image (z steps, nRho, nPhi) of a subset on its grid,
+    merged depth-first so that one grid per level is kept in memory"""
+    (subset, grid) = self.levels[level][index]
+    if level == 0:
+      if paData is None:
+        return self.weights[index][np.newaxis]
+      samples = paData[self.sampleIdx[index], subset[0], :].T
+      return samples[:, :, np.newaxis] * self.weights[index]
+    zSteps = 1 if paData is None else paData.shape[2]
+    x, y = grid.points()
+    values = np.zeros((zSteps, grid.nRho, grid.nPhi))
+    children = range(2 * index, min(2 * index + 2,
+                                    len(self.levels[level - 1])))
+    for child in children:
+      childGrid = self.levels[level - 1][child][1]
+      interpolate(self.subset_values(level - 1, child, paData),
+                  childGrid.coordinates(x, y), values)
+    return values
+
+  def backproject(self, paData):
+    """unnormalized images (z steps, nPixely, nPixelx) of paData
+    (nSamples, nSteps, z steps), or of the angular weights alone if
+    paData is None"""
+    zSteps = 1 if paData is None else paData.shape[2]
+    images = np.zeros((zSteps,) + self.xImg.shape)
+    top = len(self.levels) - 1
+    for index in range(len(self.levels[top])):
+      interpolate(self.subset_values(top, index, paData),
+                  self.imageCoords[index], images)
+    return images
+
+  def apply(self, paData, out=None):
+    """reconstruct every z step of paData (see
+    BackprojectionOperator.apply)"""
+    images = self.backproject(np.asarray(paData))
+    if out is None:
+      out = np.zeros(self.xImg.shape + (paData.shape[2],), order='F')
+    for z in range(paData.shape[2]):
+      np.divide(images[z], self.totalAngularWeight, out=out[:, :, z])
+    return out
@@ -43,39 +43,210 @@ def loadOptions(opts_path):
   f.close()
   return opts
 
+# raw pack files written by the DAQ, with or without a pack index
+RAW_FILE_PATTERN = re.compile(r'(Board[0-9]+)Experiment([0-9]+)'
+                              r'TotalFiring([0-9]+)_Pack(?:_([0-9]+))?\.bin$')
+# unpacked channel data and reconstructed images
+OUTPUT_FILE_PATTERN = re.compile(r'(chndata|reImg)_([0-9]+)(.*)\.(h5|tiff)$')
+
+class DirectoryIndex:
+  """index of raw pack files and output files in a folder
+  Raw files are kept as (board, experiment, firing, pack index) tuples,
+  pack index being None for files not renamed yet, and outputs as
+  (kind, index) tuples, kind being 'chndata' or 'reImg'.
+  The folder is listed once; refresh() only parses names that appeared
+  since the last scan, and is skipped if the folder is unchanged.
+  Files created within the timestamp tick of the last scan leave the
+  modification time unchanged: callers that create files record them
+  with add() or rename(), and refresh(force=True) rescans anyway.
+  """
+  def __init__(self, path):
+    self.path = path
+    self.mtime = None
+    self.rawFiles = {}
+    self.outputFiles = {}
+    self.otherFiles = set()
+    self.refresh()
+  def refresh(self, force=False):
+    """rescan the folder if it has been modified since the last scan"""
+    if not os.path.isdir(self.path):
+      return
+    mtime = os.stat(self.path).st_mtime
+    if not force and mtime == self.mtime:
+      return
+    self.mtime = mtime
+    fileNames = set(os.listdir(self.path))
+    knownNames = set(self.rawFiles) | set(self.outputFiles) |\
+        self.otherFiles
+    for fileName in knownNames - fileNames:
+      self.remove(fileName)
+    for fileName in fileNames - knownNames:
+      self.add(fileName)
+  def add(self, fileName):
+    """record a file created in the folder"""
+    matchObj = RAW_FILE_PATTERN.match(fileName)
+    if matchObj != None:
+      packInd = matchObj.group(4)
+      if packInd != None:
+        packInd = int(packInd)
+      self.rawFiles[fileName] = (matchObj.group(1),
+                                 int(matchObj.group(2)),
+                                 int(matchObj.group(3)), packInd)
+      return
+    matchObj = OUTPUT_FILE_PATTERN.match(fileName)
+    # chndata_<ind>.h5 only, not the stitched chndata_<start>-<end>.h5
+    if matchObj != None and (matchObj.group(1) == 'reImg' or
+                             (matchObj.group(3) == '' and
+                              matchObj.group(4) == 'h5')):
+      self.outputFiles[fileName] = (matchObj.group(1),
+                                    int(matchObj.group(2)))
+      return
+    self.otherFiles.add(fileName)
+  def remove(self, fileName):
+    """forget a file removed from the folder"""
+    self.rawFiles.pop(fileName, None)
+    self.outputFiles.pop(fileName, None)
+    self.otherFiles.discard(fileName)
+  def rename(self, oldName, newName):
+    """record a file renamed within the folder"""
+    self.remove(oldName)
+    self.add(newName)
+  def unindexed_files(self):
+    """names of raw files without a pack index"""
+    return sorted([fileName for (fileName, key) in self.rawFiles.items()
+                   if key[3] == None])
+  def max_pack_index(self):
+    """largest pack index of raw files, -1 if there is none"""
+    indList = [key[3] for key in self.rawFiles.values() if key[3] != None]
+    return max(indList) if indList else -1
+  def experiment_numbers(self, ind, totFirings):
+    """sorted "experiment" (z step) numbers found for a pack index"""
+    return sorted(set([key[1] for key in self.rawFiles.values()
+                       if key[3] == ind and key[2] == totFirings]))
+  def output_indices(self, kind='chndata'):
+    """sorted indices of chndata or reImg outputs"""
+    return sorted(set([key[1] for key in self.outputFiles.values()
+                       if key[0] == kind]))
+  def max_output_index(self, kind='chndata'):
+    """largest index of chndata or reImg outputs, -1 if there is none"""
+    indList = self.output_indices(kind)
+    return indList[-1] if indList else -1
+
+_directoryIndexCache = {}
+
+def get_directory_index(path, refresh=True):
+  """return the cached DirectoryIndex of a folder, building it on first
+  use and refreshing it incrementally afterwards"""
+  key = os.path.abspath(path)
+  dirIndex = _directoryIndexCache.get(key)
+  if dirIndex == None:
+    dirIndex = DirectoryIndex(key)
+    _directoryIndexCache[key] = dirIndex
+  elif refresh:
+    dirIndex.refresh()
+  return dirIndex
+
+# 'dtype' of stored channel data: float64, float32 or int32, the latter
+# being a scaled-integer encoding of the 10-bit samples
+DEFAULT_STORAGE = {'dtype': 'float64', 'compression': None,
+                   'compression_level': 4, 'shuffle': False}
+
+def storage_options(opts):
+  """channel data storage options from the 'extra' section"""
+  extra = opts['extra']
+  storage = dict(DEFAULT_STORAGE)
+  storage['dtype'] = extra.get('storage_dtype', storage['dtype'])
+  storage['compression'] = extra.get('compression', storage['compression'])
+  if storage['compression'] == 'none':
+    storage['compression'] = None
+  storage['compression_level'] =\
+      extra.get('compression_level', storage['compression_level'])
+  storage['shuffle'] = extra.get('shuffle', storage['compression'] != None)
+  return storage
+
+def chn_stored_dtype(storage, shape):
+  """dtype channel data of a given shape is stored with
+  Integer encoding only applies to 3D data (chndata_all), the z-averaged
+  chndata is then kept as float64."""
+  if storage == None:
+    return np.dtype(np.double)
+  dtype = np.dtype(storage['dtype'])
+  if dtype.kind in 'iu' and len(shape) != 3:
+    return np.dtype(np.double)
+  return dtype
+
+def storage_is_exact(storage):
+  """whether channel data read back from storage is bitwise the data
+  saved (float64; compression filters are lossless)"""
+  return storage == None or np.dtype(storage['dtype']) == np.double
+
+def chn_dataset_kwargs(storage, shape):
+  """keyword arguments of h5py create_dataset for channel data of a
+  given shape; 3D data is chunked by z step (samples x elements x 1)"""
+  kwargs = {'dtype': chn_stored_dtype(storage, shape)}
+  if storage == None:
+    return kwargs
+  if len(shape) == 3:
+    kwargs['chunks'] = (shape[0], shape[1], 1)
+  if storage['compression'] != None:
+    kwargs['compression'] = storage['compression']
+    if storage['compression'] == 'gzip':
+      kwargs['compression_opts'] = storage['compression_level']
+    kwargs['shuffle'] = storage['shuffle']
+  return kwargs
+
+def chn_scale_factor(storage, shape):
+  """scale factor of the integer encoding, None for float storage
+  A sample of chndata_all is -(raw - sum/nSamples)/nElements with raw
+  and sum integers, so multiplying it by nSamples*nElements gives back
+  an integer (up to rounding)."""
+  if not chn_stored_dtype(storage, shape).kind in 'iu':
+    return None
+  return float(shape[0] * shape[1])
+
+def encode_chn_data(data, storage, scale):
+  """convert channel data to its stored representation"""
+  if scale == None:
+    return data
+  return np.rint(data * scale).astype(chn_stored_dtype(storage, data.shape))
+
+def write_chn_dataset(f, name, data, storage=None):
+  """write channel data into an open HDF5 file with storage options"""
+  scale = chn_scale_factor(storage, data.shape)
+  dset = f.create_dataset(name, data=encode_chn_data(data, storage, scale),
+                          **chn_dataset_kwargs(storage, data.shape))
+  if scale != None:
+    dset.attrs['scale_factor'] = scale
+  return dset
+
+def read_chn_dataset(dset):
+  """read channel data back as a float64 Fortran-ordered array,
+  whatever its storage options"""
+  data = np.array(dset, dtype=np.double, order='F')
+  if 'scale_factor' in dset.attrs:
+    data /= dset.attrs['scale_factor']
+  return data
+
 def load_hdf5_data(desDir, ind):
   """load hdf5 file from a specific path and an index"""
   if ind == -1:
     # find the largest index in the destination folder
-    fileNameList = os.listdir(desDir)
-    pattern = re.compile(r'chndata_([0-9]+).h5')
-    indList = []
-    for fileName in fileNameList:
-      matchObj = pattern.match(fileName)
-      if matchObj != None:
-        indList.append(int(matchObj.group(1)))
-    ind = max(indList)
+    ind = get_directory_index(desDir).max_output_index('chndata')
   fileName = 'chndata_' + str(ind) + '.h5'
   inputPath = os.path.join(desDir, fileName)
   notifyCli('Opening data from ' + inputPath)
   f = h5py.File(inputPath, 'r')
-  chndata = np.array(f['chndata'], order='F') 
-  chndata_all = np.array(f['chndata_all'], order='F')
+  chndata = read_chn_dataset(f['chndata'])
+  chndata_all = read_chn_dataset(f['chndata_all'])
   f.close()
   return (chndata, chndata_all)
 
 def save_reconstructed_image(reImg, desDir, ind, out_format, sufix=''):
   """save reconstructed image to a specific path and an index"""
+  dirIndex = get_directory_index(desDir)
   if ind == -1:
     # find the largest index in the destination folder
-    fileNameList = os.listdir(desDir)
-    pattern = re.compile(r'chndata_([0-9]+).h5')
-    indList = []
-    for fileName in fileNameList:
-      matchObj = pattern.match(fileName)
-      if matchObj != None:
-        indList.append(int(matchObj.group(1)))
-    ind = max(indList)
+    ind = dirIndex.max_output_index('chndata')
   if out_format == 'hdf5':
     fileName = 'reImg_' + str(ind) + '.h5'
     outPath = os.path.join(desDir, fileName)
@@ -89,34 +260,44 @@ def save_reconstructed_image(reImg, desDir, ind, out_format, sufix=''):
     notifyCli('Saving image data to ' + outPath)
     imageList = [reImg[:,:,i] for i in range(reImg.shape[2])]
     fi.write_multipage(imageList, outPath)
+  else:
+    return
+  dirIndex.add(fileName)
+
+def last_true(mask, default):
+  """index of the last True along axis 0 of mask, default where none"""
+  lastIdx = mask.shape[0] - 1 - np.argmax(mask[::-1], axis=0)
+  return np.where(mask.any(axis=0), lastIdx, default)
 
 def find_delay_idx(paData, fs):
   """find the delay value from the first few samples on
-  A-lines"""
-  nSteps = paData.shape[1]
-  refImpulse = paData[0:100,:]
+  A-lines
+  paData is one z step (samples, detectors), or a batch of z steps
+  (samples, detectors, z steps), in which case delays are returned per
+  detector and z step. The envelope and threshold crossings are computed
+  along the sample axis for all A-lines at once.
+  """
+  refImpulse = paData[0:100]
   refImpulseEnv = np.abs(spsig.hilbert(refImpulse, axis=0))
   impuMax = np.amax(refImpulseEnv, axis=0)
   # to be consistent with MATLAB's implementation ddof = 1
   tempStd = np.std(refImpulseEnv, axis=0, ddof=1)
-  delayIdx = - np.ones(nSteps) * 18 / fs
-  for n in range(nSteps):
-    if (impuMax[n] > 3.0*tempStd[n] and impuMax[n] > 0.1):
-      tmpThresh = 2*tempStd[n]
-      m1 = 14
-      for ii in range(14,50):
-        if (refImpulse[ii-1,n] > -tmpThresh and\
-                    refImpulse[ii,n] < -tmpThresh):
-                    m1 = ii
-                    break
-      m2 = m1
-      m3 = m1
-      for ii in range(9,m1+1):
-        if (refImpulse[ii-1,n] < tmpThresh and\
-                    refImpulse[ii,n] > tmpThresh):
-                    m2 = ii
-        if (refImpulse[ii-1,n] > tmpThresh and\
-                    refImpulse[ii,n] < tmpThresh):
-                    m3 = ii
-      delayIdx[n] = -float(m2 + m3 + 2) / 2 / fs
+  delayIdx = - np.ones(paData.shape[1:]) * 18 / fs
+  valid = (impuMax > 3.0*tempStd) & (impuMax > 0.1)
+  tmpThresh = 2*tempStd
+  refImpulse = np.asarray(refImpulse[0:50])
+  # m1: first sample in [14, 50) crossing -tmpThresh downwards
+  down = (refImpulse[13:49] > -tmpThresh) &\
+      (refImpulse[14:50] < -tmpThresh)
+  m1 = np.where(down.any(axis=0), 14 + np.argmax(down, axis=0), 14)
+  # m2 and m3: last samples in [9, m1] crossing tmpThresh upwards and
+  # downwards respectively
+  inRange = (np.arange(9, 50).reshape((-1,) + (1,) * m1.ndim) <= m1)
+  up = (refImpulse[8:49] < tmpThresh) &\
+      (refImpulse[9:50] > tmpThresh) & inRange
+  down = (refImpulse[8:49] > tmpThresh) &\
+      (refImpulse[9:50] < tmpThresh) & inRange
+  m2 = last_true(up, m1 - 9) + 9
+  m3 = last_true(down, m1 - 9) + 9
+  delayIdx[valid] = - (m2 + m3 + 2)[valid].astype(np.double) / 2 / fs
   return delayIdx
@@ -3,68 +3,140 @@
 #include <math.h>
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 
 // implementation function
+// RECON_TILE_IMP(name, index type, weight type) defines, per table data
+// type, the loop over pixels [p0, p1) of the image. Detectors are
+// iterated inside the tile, so that its part of the image stays in
+// cache, and every pixel sums detectors in the same order whatever the
+// tiling; the sum is always in double precision.
+#define RECON_TILE_IMP(NAME, IDX_T, WEIGHT_T)				\
+  static void NAME(const npy_double *pa_data,				\
+		   const void *idxTable,				\
+		   const void *weightTable,				\
+		   npy_intp nPixels, int nSteps, int nTimeSamples,	\
+		   npy_intp p0, npy_intp p1,				\
+		   npy_double *pa_img) {				\
+    const IDX_T *idxAll = (const IDX_T *)idxTable;			\
+    const WEIGHT_T *angularWeight = (const WEIGHT_T *)weightTable;	\
+    int iStep;								\
+    npy_intp p, icount, iskip;						\
+									\
+    for (iStep=0; iStep<nSteps; iStep++) {				\
+      icount = nPixels * iStep;						\
+      iskip = (npy_intp)nTimeSamples * iStep - 1;			\
+      for (p=p0; p<p1; p++) {						\
+	pa_img[p] +=							\
+	  pa_data[(npy_intp)idxAll[icount+p]+iskip] *			\
+	  (npy_double)angularWeight[icount+p];				\
+      }									\
+    }									\
+  }
+
+RECON_TILE_IMP(recon_tile_u64_f64, npy_uint64, npy_double)
+RECON_TILE_IMP(recon_tile_u64_f32, npy_uint64, npy_float)
+RECON_TILE_IMP(recon_tile_u32_f64, npy_uint32, npy_double)
+RECON_TILE_IMP(recon_tile_u32_f32, npy_uint32, npy_float)
+RECON_TILE_IMP(recon_tile_u16_f64, npy_uint16, npy_double)
+RECON_TILE_IMP(recon_tile_u16_f32, npy_uint16, npy_float)
+
+// number of pixels of a tile; its image and the A-line of a detector
+// fit in the L1/L2 caches
+#define RECON_TILE_SIZE 1024
+
+typedef void (*recon_tile_func)(const npy_double *, const void *,
+				const void *, npy_intp, int, int,
+				npy_intp, npy_intp, npy_double *);
+
 void recon_loop_imp(const npy_double *pa_data,
-		    const npy_uint64 *idxAll,
-		    const npy_double *angularWeight,
+		    const void *idxAll, int idxType,
+		    const void *angularWeight, int weightType,
 		    int nPixelx, int nPixely, int nSteps,
-		    int nTimeSamples,
+		    int nTimeSamples, int nThreads,
 		    npy_double *pa_img) {
-  int iStep, y, x, icount, pcount, iskip;
-
-  icount = 0;
-  for (iStep=0; iStep<nSteps; iStep++) {
-    pcount = 0;
-    iskip = nTimeSamples * iStep - 1;
-    /* iskip = 1301 * iStep - 1; */
-    for (y=0; y<nPixely; y++) {
-      for (x=0; x<nPixelx; x++) {
-	pa_img[pcount++] +=
-	  pa_data[(int)idxAll[icount]+iskip] *
-	  angularWeight[icount];
-	icount++;
-      }
-    }
+  recon_tile_func tileFunc;
+  npy_intp nPixels, nTiles, tile, p0, p1;
+
+  if (idxType == NPY_UINT64)
+    tileFunc = weightType == NPY_FLOAT64 ?
+      recon_tile_u64_f64 : recon_tile_u64_f32;
+  else if (idxType == NPY_UINT32)
+    tileFunc = weightType == NPY_FLOAT64 ?
+      recon_tile_u32_f64 : recon_tile_u32_f32;
+  else
+    tileFunc = weightType == NPY_FLOAT64 ?
+      recon_tile_u16_f64 : recon_tile_u16_f32;
+  nPixels = (npy_intp)nPixelx * nPixely;
+  nTiles = (nPixels + RECON_TILE_SIZE - 1) / RECON_TILE_SIZE;
+  if (nThreads < 1)
+    nThreads = 1;
+  // tiles write to disjoint parts of the image
+#pragma omp parallel for num_threads(nThreads) schedule(dynamic) private(p0, p1)
+  for (tile=0; tile<nTiles; tile++) {
+    p0 = tile * RECON_TILE_SIZE;
+    p1 = p0 + RECON_TILE_SIZE < nPixels ? p0 + RECON_TILE_SIZE : nPixels;
+    tileFunc(pa_data, idxAll, angularWeight, nPixels, nSteps,
+	     nTimeSamples, p0, p1, pa_img);
   }
 }
 
+// index table types are NPY_UINT16, NPY_UINT32 or NPY_UINT64
+static int valid_index_type(int typeNum) {
+  return (typeNum == NPY_UINT16 || typeNum == NPY_UINT32 ||
+	  typeNum == NPY_UINT64);
+}
+
+// weight table types are NPY_FLOAT32 or NPY_FLOAT64
+static int valid_weight_type(int typeNum) {
+  return (typeNum == NPY_FLOAT32 || typeNum == NPY_FLOAT64);
+}
+
 // interface function
 // inputs:
 //   pa_data: numpy.ndarray, ndim=2, dtype=numpy.double
-//   idxAll: numpy.ndarray, ndim=3, dtype=numpy.uint
-//   angularWeight: numpy.ndarray, ndim=3, dtype=numpy.double
+//   idxAll: numpy.ndarray, ndim=3, dtype=numpy.uint16, uint32 or uint64
+//   angularWeight: numpy.ndarray, ndim=3, dtype=numpy.float32 or float64
 //   nPixelx: int
 //   nPixely: int
 //   nSteps: int
+//   nThreads: (optional) int, number of threads (1 by default); the GIL
+//             is released while the loop runs
+//   out: (optional) numpy.ndarray, ndim=2, dtype=numpy.double, Fortran-
+//        ordered buffer of the image, overwritten and returned instead
+//        of a new array
 // output:
 //   pa_img: numpy.ndarray, ndim=2, dtype=numpy.double
 static PyObject* recon_loop(PyObject* self, PyObject* args) {
-  PyArrayObject *p_pa_data, *p_idxAll, *p_angularWeight;
-  int nPixelx, nPixely, nSteps;
+  PyArrayObject *p_pa_data, *p_idxAll, *p_angularWeight, *p_out = NULL;
+  int nPixelx, nPixely, nSteps, nThreads = 1;
   PyObject *p_pa_img;
   npy_intp dim_pa_img[2];
 
   int paDataValid, idxAllValid, angularWeightValid;
-  npy_double *pa_data, *angularWeight;
-  npy_uint64 *idxAll;
+  int idxType, weightType, nTimeSamples;
+  npy_double *pa_data;
+  void *idxAll, *angularWeight;
   npy_double *pa_img;
 
   // extract argument tuple
-  if (!PyArg_ParseTuple(args, "O!O!O!iii",
+  if (!PyArg_ParseTuple(args, "O!O!O!iii|iO!",
   			&PyArray_Type, &p_pa_data,
   			&PyArray_Type, &p_idxAll,
   			&PyArray_Type, &p_angularWeight,
-  			&nPixelx, &nPixely, &nSteps)) {
+  			&nPixelx, &nPixely, &nSteps, &nThreads,
+			&PyArray_Type, &p_out)) {
     return Py_None;
   }
 
   // extract and validate variables
-  paDataValid = (PyArray_ISFLOAT(p_pa_data)) &&
+  idxType = PyArray_TYPE(p_idxAll);
+  weightType = PyArray_TYPE(p_angularWeight);
+  paDataValid = (PyArray_TYPE(p_pa_data) == NPY_DOUBLE) &&
     (PyArray_CHKFLAGS(p_pa_data, NPY_ARRAY_FARRAY));
-  idxAllValid = (PyArray_ISUNSIGNED(p_idxAll)) &&
+  idxAllValid = valid_index_type(idxType) &&
     (PyArray_CHKFLAGS(p_idxAll, NPY_ARRAY_FARRAY));
-  angularWeightValid = (PyArray_ISFLOAT(p_angularWeight)) &&
+  angularWeightValid = valid_weight_type(weightType) &&
     (PyArray_CHKFLAGS(p_angularWeight, NPY_ARRAY_FARRAY));
   if (!paDataValid || !idxAllValid || !angularWeightValid) {
     printf("%d, %d, %d\n", paDataValid, idxAllValid, angularWeightValid);
@@ -72,17 +144,32 @@ static PyObject* recon_loop(PyObject* self, PyObject* args) {
   }
   dim_pa_img[0] = nPixely;
   dim_pa_img[1] = nPixelx;
-  p_pa_img = PyArray_ZEROS(2, dim_pa_img, NPY_DOUBLE, 1);
+  if (p_out != NULL) {
+    if (PyArray_TYPE(p_out) != NPY_DOUBLE ||
+	!PyArray_CHKFLAGS(p_out, NPY_ARRAY_FARRAY) ||
+	PyArray_SIZE(p_out) != (npy_intp)nPixelx * nPixely) {
+      PyErr_SetString(PyExc_ValueError, "out must be a writeable "
+		      "Fortran-ordered image of doubles");
+      return NULL;
+    }
+    memset(PyArray_DATA(p_out), 0, PyArray_NBYTES(p_out));
+    Py_INCREF(p_out);
+    p_pa_img = (PyObject *)p_out;
+  }
+  else
+    p_pa_img = PyArray_ZEROS(2, dim_pa_img, NPY_DOUBLE, 1);
   pa_data = (npy_double *)PyArray_DATA(p_pa_data);
-  idxAll = (npy_uint64 *)PyArray_DATA(p_idxAll);
-  angularWeight = (npy_double *)PyArray_DATA(p_angularWeight);
+  idxAll = PyArray_DATA(p_idxAll);
+  angularWeight = PyArray_DATA(p_angularWeight);
   pa_img = (npy_double *)PyArray_DATA(p_pa_img);
+  nTimeSamples = PyArray_SHAPE(p_pa_data)[0];
 
   // call implementation function
-  recon_loop_imp(pa_data, idxAll, angularWeight,
-		 nPixelx, nPixely, nSteps,
-		 PyArray_SHAPE(p_pa_data)[0],
+  Py_BEGIN_ALLOW_THREADS
+  recon_loop_imp(pa_data, idxAll, idxType, angularWeight, weightType,
+		 nPixelx, nPixely, nSteps, nTimeSamples, nThreads,
 		 pa_img);
+  Py_END_ALLOW_THREADS
 
   // return value
   return p_pa_img;
@@ -99,7 +186,8 @@ void find_index_map_and_angular_weight_imp
 (const int nSteps, const npy_double *xImg, const npy_double *yImg,
  const npy_double *xReceive, const npy_double *yReceive, const npy_double *delayIdx,
  const npy_double vm, const npy_double fs, const long nSize2D,
- npy_uint64 *idxAll, npy_double *angularWeight, npy_double *totalAngularWeight) {
+ const long maxIdx, const int idxType, const int weightType,
+ void *idxAll, void *angularWeight, npy_double *totalAngularWeight) {
   /* Reference python codes
 def find_index_map_and_angular_weight\
     (nSteps, xImg, yImg, xReceive, yReceive, delayIdx, vm, fs):
@@ -122,19 +210,37 @@ def find_index_map_and_angular_weight\
     return (idxAll, angularWeight, totalAngularWeight)
   */
 
-  int n, i;
-  npy_double r0, rr0, dx, dy, cosAlpha;
+  /* If maxIdx > 0, indices below 0 or above maxIdx are set to 1, as
+     the python code does with idxAll[idxAll > nSamples] = 1, so that
+     they also fit in narrow index types. */
+
+  int n;
+  long i, k;
+  npy_double r0, rr0, dx, dy, cosAlpha, weight, idx;
   for (n=0; n<nSteps; n++) {
     r0 = sqrt(xReceive[n]*xReceive[n] + yReceive[n]*yReceive[n]);
     for (i=0; i<nSize2D; i++) {
+      k = n*nSize2D+i;
       dx = xImg[i] - xReceive[n];
       dy = yImg[i] - yReceive[n];
       rr0 = sqrt(dx*dx + dy*dy);
       cosAlpha = fabs((-xReceive[n]*dx-yReceive[n]*dy)/r0/rr0);
       cosAlpha = cosAlpha<0.999 ? cosAlpha : 0.999;
-      angularWeight[n*nSize2D+i] = cosAlpha / (rr0 * rr0);
-      totalAngularWeight[i] += angularWeight[n*nSize2D+i];
-      idxAll[n*nSize2D+i] = (npy_uint64)round((rr0/vm - delayIdx[n]) * fs);
+      weight = cosAlpha / (rr0 * rr0);
+      totalAngularWeight[i] += weight;
+      if (weightType == NPY_FLOAT32)
+	((npy_float *)angularWeight)[k] = (npy_float)weight;
+      else
+	((npy_double *)angularWeight)[k] = weight;
+      idx = round((rr0/vm - delayIdx[n]) * fs);
+      if (maxIdx > 0 && (idx < 0 || idx > maxIdx))
+	idx = 1;
+      if (idxType == NPY_UINT16)
+	((npy_uint16 *)idxAll)[k] = (npy_uint16)idx;
+      else if (idxType == NPY_UINT32)
+	((npy_uint32 *)idxAll)[k] = (npy_uint32)idx;
+      else
+	((npy_uint64 *)idxAll)[k] = (npy_uint64)idx;
     }
   }
 }
@@ -149,20 +255,27 @@ def find_index_map_and_angular_weight\
 //   delayIdx: ndarray, ndim=1, dtype=double, length=nSteps
 //   vm: double scalar
 //   fs: double scalar
+//   maxIdx: (optional) int, indices outside [0, maxIdx] are set to 1,
+//           not checked if 0 (the default)
+//   idxDtype: (optional) numpy.uint16, uint32 or uint64 (the default)
+//   weightDtype: (optional) numpy.float32 or float64 (the default)
 // outputs:
-//   idxAll: ndarray, ndim=3, dtype=uint,
+//   idxAll: ndarray, ndim=3, dtype=idxDtype,
 //           size=[nPixelx,nPixely,nSteps]
-//   angularWeight: same as idxAll, except dtype=double
+//   angularWeight: same as idxAll, except dtype=weightDtype
 //   totalAngularWeight: same as angularWeight, except 2D
 static PyObject* find_index_map_and_angular_weight(PyObject* self, PyObject* args) {
   PyArrayObject *p_xImg, *p_yImg, *p_xReceive, *p_yReceive, *p_delayIdx;
   // PyArrayObject *p_idxAll, *p_angularWeight, *p_totalAngularWeight;
   PyObject *p_idxAll, *p_angularWeight, *p_totalAngularWeight;
   int nSteps;
+  long maxIdx = 0;
+  PyArray_Descr *idxDescr = NULL, *weightDescr = NULL;
+  int idxType = NPY_UINT64, weightType = NPY_FLOAT64;
   npy_double vm, fs;
   npy_double *xImg, *yImg, *xReceive, *yReceive, *delayIdx;
-  npy_uint64 *idxAll;
-  npy_double *angularWeight, *totalAngularWeight;
+  void *idxAll, *angularWeight;
+  npy_double *totalAngularWeight;
 
   PyObject *returnTuple = PyTuple_New(3);
 
@@ -171,16 +284,33 @@ static PyObject* find_index_map_and_angular_weight(PyObject* self, PyObject* arg
   npy_intp dim_2d[2];
 
   // extract argument tuple
-  if (!PyArg_ParseTuple(args, "iO!O!O!O!O!dd",
+  if (!PyArg_ParseTuple(args, "iO!O!O!O!O!dd|lO&O&",
 			&nSteps,
 			&PyArray_Type, &p_xImg,
 			&PyArray_Type, &p_yImg,
 			&PyArray_Type, &p_xReceive,
 			&PyArray_Type, &p_yReceive,
 			&PyArray_Type, &p_delayIdx,
-			&vm, &fs)) {
+			&vm, &fs, &maxIdx,
+			PyArray_DescrConverter2, &idxDescr,
+			PyArray_DescrConverter2, &weightDescr)) {
     goto fail;
   }
+  if (idxDescr != NULL) {
+    idxType = idxDescr->type_num;
+    Py_DECREF(idxDescr);
+  }
+  if (weightDescr != NULL) {
+    weightType = weightDescr->type_num;
+    Py_DECREF(weightDescr);
+  }
+  if (!valid_index_type(idxType) || !valid_weight_type(weightType)) {
+    PyErr_SetString(PyExc_ValueError,
+		    "index type must be uint16, uint32 or uint64 and "
+		    "weight type float32 or float64");
+    Py_DECREF(returnTuple);
+    return NULL;
+  }
 
   // TODO: validate array objects
 
@@ -196,17 +326,17 @@ static PyObject* find_index_map_and_angular_weight(PyObject* self, PyObject* arg
   dim_3d[2] = nSteps;
   dim_2d[0] = PyArray_SHAPE(p_xImg)[0];
   dim_2d[1] = PyArray_SHAPE(p_xImg)[1];
-  p_idxAll = PyArray_ZEROS(3, dim_3d, NPY_UINT64, 1);
-  p_angularWeight = PyArray_ZEROS(3, dim_3d, NPY_DOUBLE, 1);
+  p_idxAll = PyArray_ZEROS(3, dim_3d, idxType, 1);
+  p_angularWeight = PyArray_ZEROS(3, dim_3d, weightType, 1);
   p_totalAngularWeight = PyArray_ZEROS(2, dim_2d, NPY_DOUBLE, 1);
-  idxAll = (npy_uint64 *)PyArray_DATA(p_idxAll);
-  angularWeight = (npy_double *)PyArray_DATA(p_angularWeight);
+  idxAll = PyArray_DATA(p_idxAll);
+  angularWeight = PyArray_DATA(p_angularWeight);
   totalAngularWeight = (npy_double *)PyArray_DATA(p_totalAngularWeight);
 
   // Call the implementation
   find_index_map_and_angular_weight_imp
     (nSteps, xImg, yImg, xReceive, yReceive, delayIdx,
-     vm, fs, dim_2d[0] * dim_2d[1],
+     vm, fs, dim_2d[0] * dim_2d[1], maxIdx, idxType, weightType,
      idxAll, angularWeight, totalAngularWeight);
 
   // return results
@@ -224,10 +354,462 @@ static PyObject* find_index_map_and_angular_weight(PyObject* self, PyObject* arg
 }
 
 
+// table-free backprojection of pixels [p0, p1) for nz z steps: delays
+// and angular weights are computed on the fly, with the same
+// expressions as find_index_map_and_angular_weight_imp, and each
+// pixel sums detectors in the same order as recon_loop_imp
+static void recon_tile_on_the_fly
+(const npy_double *pa_data, int nTimeSamples, int nSteps, int nz,
+ const npy_double *xImg, const npy_double *yImg, npy_intp nPixels,
+ const npy_double *xReceive, const npy_double *yReceive,
+ const npy_double *delayIdx, npy_double vm, npy_double fs,
+ npy_intp p0, npy_intp p1,
+ npy_double *pa_img, npy_double *totalAngularWeight) {
+  int n, z;
+  npy_intp p, iskip, zStride;
+  npy_double r0, rr0, dx, dy, cosAlpha, weight, idx;
+
+  zStride = (npy_intp)nTimeSamples * nSteps;
+  for (n=0; n<nSteps; n++) {
+    r0 = sqrt(xReceive[n]*xReceive[n] + yReceive[n]*yReceive[n]);
+    iskip = (npy_intp)nTimeSamples * n - 1;
+    for (p=p0; p<p1; p++) {
+      dx = xImg[p] - xReceive[n];
+      dy = yImg[p] - yReceive[n];
+      rr0 = sqrt(dx*dx + dy*dy);
+      cosAlpha = fabs((-xReceive[n]*dx-yReceive[n]*dy)/r0/rr0);
+      cosAlpha = cosAlpha<0.999 ? cosAlpha : 0.999;
+      weight = cosAlpha / (rr0 * rr0);
+      totalAngularWeight[p] += weight;
+      idx = round((rr0/vm - delayIdx[n]) * fs);
+      if (idx < 0 || idx > nTimeSamples)
+	idx = 1;
+      for (z=0; z<nz; z++)
+	pa_img[z*nPixels+p] +=
+	  pa_data[z*zStride+(npy_intp)idx+iskip] * weight;
+    }
+  }
+}
+
+void recon_on_the_fly_imp
+(const npy_double *pa_data, int nTimeSamples, int nSteps, int nz,
+ const npy_double *xImg, const npy_double *yImg, npy_intp nPixels,
+ const npy_double *xReceive, const npy_double *yReceive,
+ const npy_double *delayIdx, npy_double vm, npy_double fs, int nThreads,
+ npy_double *pa_img, npy_double *totalAngularWeight) {
+  npy_intp nTiles, tile, p0, p1;
+
+  nTiles = (nPixels + RECON_TILE_SIZE - 1) / RECON_TILE_SIZE;
+  if (nThreads < 1)
+    nThreads = 1;
+#pragma omp parallel for num_threads(nThreads) schedule(dynamic) private(p0, p1)
+  for (tile=0; tile<nTiles; tile++) {
+    p0 = tile * RECON_TILE_SIZE;
+    p1 = p0 + RECON_TILE_SIZE < nPixels ? p0 + RECON_TILE_SIZE : nPixels;
+    recon_tile_on_the_fly(pa_data, nTimeSamples, nSteps, nz,
+			  xImg, yImg, nPixels, xReceive, yReceive,
+			  delayIdx, vm, fs, p0, p1,
+			  pa_img, totalAngularWeight);
+  }
+}
+
+// table-free reconstruction, using O(pixels) memory
+// inputs:
+//   pa_data: numpy.ndarray, ndim=2 (one z step) or 3 (z steps along the
+//            last axis), dtype=numpy.double, Fortran-ordered
+//   xImg, yImg, xReceive, yReceive, delayIdx, vm, fs: same as for
+//            find_index_map_and_angular_weight
+//   nThreads: (optional) int, number of threads (1 by default)
+// outputs:
+//   pa_img: ndarray, dtype=double, size=[nPixely,nPixelx(,nz)], equal to
+//           what recon_loop gives with uint64 and float64 tables
+//   totalAngularWeight: ndarray, ndim=2, dtype=double
+static PyObject* recon_on_the_fly(PyObject* self, PyObject* args) {
+  PyArrayObject *p_pa_data, *p_xImg, *p_yImg, *p_xReceive, *p_yReceive,
+    *p_delayIdx;
+  PyObject *p_pa_img, *p_totalAngularWeight;
+  npy_double vm, fs;
+  int nThreads = 1, nz, nTimeSamples, nSteps;
+  npy_intp dim_img[3];
+
+  if (!PyArg_ParseTuple(args, "O!O!O!O!O!O!dd|i",
+			&PyArray_Type, &p_pa_data,
+			&PyArray_Type, &p_xImg,
+			&PyArray_Type, &p_yImg,
+			&PyArray_Type, &p_xReceive,
+			&PyArray_Type, &p_yReceive,
+			&PyArray_Type, &p_delayIdx,
+			&vm, &fs, &nThreads)) {
+    return NULL;
+  }
+  if (PyArray_TYPE(p_pa_data) != NPY_DOUBLE ||
+      !PyArray_CHKFLAGS(p_pa_data, NPY_ARRAY_FARRAY) ||
+      PyArray_NDIM(p_pa_data) < 2 || PyArray_NDIM(p_pa_data) > 3) {
+    PyErr_SetString(PyExc_ValueError, "pa_data must be a Fortran-ordered "
+		    "2D or 3D array of doubles");
+    return NULL;
+  }
+  nTimeSamples = PyArray_SHAPE(p_pa_data)[0];
+  nSteps = PyArray_SHAPE(p_pa_data)[1];
+  nz = PyArray_NDIM(p_pa_data) == 3 ? PyArray_SHAPE(p_pa_data)[2] : 1;
+
+  dim_img[0] = PyArray_SHAPE(p_xImg)[0];
+  dim_img[1] = PyArray_SHAPE(p_xImg)[1];
+  dim_img[2] = nz;
+  p_pa_img = PyArray_ZEROS(PyArray_NDIM(p_pa_data), dim_img, NPY_DOUBLE, 1);
+  p_totalAngularWeight = PyArray_ZEROS(2, dim_img, NPY_DOUBLE, 1);
+
+  Py_BEGIN_ALLOW_THREADS
+  recon_on_the_fly_imp
+    ((npy_double *)PyArray_DATA(p_pa_data), nTimeSamples, nSteps, nz,
+     (npy_double *)PyArray_DATA(p_xImg), (npy_double *)PyArray_DATA(p_yImg),
+     dim_img[0] * dim_img[1],
+     (npy_double *)PyArray_DATA(p_xReceive),
+     (npy_double *)PyArray_DATA(p_yReceive),
+     (npy_double *)PyArray_DATA(p_delayIdx), vm, fs, nThreads,
+     (npy_double *)PyArray_DATA((PyArrayObject *)p_pa_img),
+     (npy_double *)PyArray_DATA((PyArrayObject *)p_totalAngularWeight));
+  Py_END_ALLOW_THREADS
+
+  return Py_BuildValue("NN", p_pa_img, p_totalAngularWeight);
+}
+
+// focal-line backprojection, the CPU counterpart of the kernels of
+// reconstruct_3d_kernel.cu. Both functions repeat the single precision
+// expressions of the kernels, in the same order, so that the results
+// only differ from the GPU by its fused multiply-adds.
+
+#define FOCAL_SIGN(x) ((x) > 0.0 ? 1 : -1)
+
+// cosAlpha and tempc of every pixel column (xi, yi) and transducer ni,
+// at [ni + nSteps*(yi + ny*xi)] as calculate_cos_alpha_and_tempc
+void focal_line_precompute_imp
+(const npy_float *xRange, const npy_float *yRange,
+ const npy_float *xReceive, const npy_float *yReceive,
+ int nx, int ny, int nSteps, npy_float lenR, int nThreads,
+ npy_float *cosAlpha, npy_float *tempc) {
+  npy_intp col;
+
+  if (nThreads < 1)
+    nThreads = 1;
+#pragma omp parallel for num_threads(nThreads) schedule(static)
+  for (col=0; col<(npy_intp)nx*ny; col++) {
+    int xi = col / ny, yi = col % ny, ni;
+    npy_intp idx;
+    npy_float dx, dy, r0, rr0;
+    for (ni=0; ni<nSteps; ni++) {
+      idx = ni + nSteps * col;
+      dx = xRange[xi] - xReceive[ni];
+      dy = yRange[yi] - yReceive[ni];
+      r0 = sqrtf(xReceive[ni]*xReceive[ni] + yReceive[ni]*yReceive[ni]);
+      rr0 = sqrtf(dx*dx + dy*dy);
+      cosAlpha[idx] = fabsf((-xReceive[ni]*dx-yReceive[ni]*dy)/r0/rr0);
+      tempc[idx] = rr0 - lenR/cosAlpha[idx];
+    }
+  }
+}
+
+// whether a voxel dz above a scanning plane is within the aperture of a
+// transducer, the test of backprojection_kernel_fast
+static inline int focal_in_aperture(npy_float dz, npy_float tempc,
+				    npy_double dzLimit) {
+  return fabsf(dz/tempc) < dzLimit;
+}
+
+// voxel of the ascending zRange closest to the plane at zPlane
+static int focal_nearest_z(const npy_float *zRange, int nz, npy_float zPlane) {
+  int lo = 0, hi = nz, mid;
+
+  while (lo < hi) {
+    mid = lo + (hi - lo) / 2;
+    if (zRange[mid] < zPlane)
+      lo = mid + 1;
+    else
+      hi = mid;
+  }
+  if (lo == nz)
+    return nz - 1;
+  if (lo > 0 && fabsf(zRange[lo-1] - zPlane) < fabsf(zRange[lo] - zPlane))
+    return lo - 1;
+  return lo;
+}
+
+// voxels [*z0, *z1) of a column within the aperture of a transducer.
+// As zRange is ascending, |dz| decreases then increases along the column,
+// so the voxels passing focal_in_aperture are contiguous around zNear and
+// their bounds are found by bisection with the same test.
+static void focal_z_window(const npy_float *zRange, int nz, npy_float zPlane,
+			   int zNear, npy_float tempc, npy_double dzLimit,
+			   int *z0, int *z1) {
+  int lo, hi, mid;
+
+  if (!focal_in_aperture(zRange[zNear] - zPlane, tempc, dzLimit)) {
+    *z0 = *z1 = zNear;
+    return;
+  }
+  // first voxel within the aperture
+  lo = 0;
+  hi = zNear;
+  while (lo < hi) {
+    mid = lo + (hi - lo) / 2;
+    if (focal_in_aperture(zRange[mid] - zPlane, tempc, dzLimit))
+      hi = mid;
+    else
+      lo = mid + 1;
+  }
+  *z0 = lo;
+  // first voxel beyond the aperture
+  lo = zNear + 1;
+  hi = nz;
+  while (lo < hi) {
+    mid = lo + (hi - lo) / 2;
+    if (focal_in_aperture(zRange[mid] - zPlane, tempc, dzLimit))
+      lo = mid + 1;
+    else
+      hi = mid;
+  }
+  *z1 = lo;
+}
+
+// adds the A-lines of nPlanes scanning planes to img, at
+// [zi + nz*(yi + ny*xi)] as backprojection_kernel_fast; line li of
+// plane pi is the A-line of transducer transducers[li + nLines*pi].
+// Every pixel sums planes, then lines, in order, as the GPU does with
+// one kernel call per line. zRange must be ascending: only the voxels
+// within the aperture of each transducer (see focal_z_window) are visited.
+void focal_line_backproject_imp
+(const npy_float *pa_data, int nSamples, int nLines, int nPlanes,
+ const npy_float *cosAlpha_, const npy_float *tempc_,
+ const npy_float *zRange, const npy_float *zReceive,
+ const npy_int32 *transducers, const npy_float *delayIdx,
+ int nx, int ny, int nz, int nSteps,
+ npy_float lenR, npy_float vm, npy_float fs, int nThreads,
+ npy_float *img) {
+  int pi, zNear;
+  npy_intp col;
+
+  if (nThreads < 1)
+    nThreads = 1;
+  if (nz < 1)
+    return;
+#pragma omp parallel num_threads(nThreads) private(pi, zNear)
+  for (pi=0; pi<nPlanes; pi++) {
+    zNear = focal_nearest_z(zRange, nz, zReceive[pi]);
+    // pixel columns write to disjoint parts of img
+#pragma omp for schedule(static)
+    for (col=0; col<(npy_intp)nx*ny; col++) {
+      int li, zi, ti, z0, z1;
+      size_t idx0;
+      npy_float cosAlpha, tempc, tempc2, sign, lenRCos, dz, root, rr0,
+	angleWeightB;
+      npy_double dzLimit;
+      npy_float *imgCol = img + nz * col;
+      const npy_float *paDataLine;
+      for (li=0; li<nLines; li++) {
+	ti = transducers[li + (npy_intp)nLines * pi];
+	// in-plane terms, shared by the voxels of the column
+	cosAlpha = cosAlpha_[ti + nSteps * col];
+	tempc = tempc_[ti + nSteps * col];
+	dzLimit = fabs(10.0/lenR/cosAlpha);
+	focal_z_window(zRange, nz, zReceive[pi], zNear, tempc, dzLimit,
+		       &z0, &z1);
+	if (z0 == z1)
+	  continue;
+	paDataLine = pa_data + (npy_intp)nSamples * (li + nLines * pi);
+	tempc2 = tempc*tempc;
+	sign = FOCAL_SIGN(tempc);
+	lenRCos = lenR/cosAlpha;
+	for (zi=z0; zi<z1; zi++) {
+	  dz = zRange[zi] - zReceive[pi];
+	  root = sqrtf(tempc2 + dz*dz);
+	  rr0 = root*sign + lenRCos;
+	  angleWeightB = tempc/root*cosAlpha/(rr0*rr0);
+	  idx0 = (size_t)lroundf((rr0/vm-delayIdx[ti])*fs);
+	  if (idx0 < (size_t)nSamples) {
+	    imgCol[zi] += paDataLine[idx0] / angleWeightB;
+	  }
+	}
+      }
+    }
+  }
+}
+
+// single precision 1D array of n elements
+static int valid_float_vector(PyArrayObject *p, npy_intp n) {
+  return PyArray_TYPE(p) == NPY_FLOAT32 &&
+    PyArray_CHKFLAGS(p, NPY_ARRAY_CARRAY_RO) &&
+    PyArray_NDIM(p) == 1 && PyArray_SHAPE(p)[0] == n;
+}
+
+// cosAlpha and tempc tables of the focal-line backprojection
+// inputs:
+//   xRange: numpy.ndarray, ndim=1, dtype=numpy.float32, x of the pixels
+//   yRange: same as xRange, y of the pixels
+//   xReceive: numpy.ndarray, ndim=1, dtype=numpy.float32, length=nSteps
+//   yReceive: same as xReceive
+//   lenR: float, focal length of the transducers
+//   nThreads: (optional) int, number of threads (1 by default)
+// outputs:
+//   cosAlpha: numpy.ndarray, dtype=numpy.float32,
+//             size=[nPixelx,nPixely,nSteps], C-ordered
+//   tempc: same as cosAlpha
+static PyObject* focal_line_precompute(PyObject* self, PyObject* args) {
+  PyArrayObject *p_xRange, *p_yRange, *p_xReceive, *p_yReceive;
+  PyObject *p_cosAlpha, *p_tempc;
+  float lenR;
+  int nThreads = 1, nx, ny, nSteps;
+  npy_intp dim_table[3];
+
+  if (!PyArg_ParseTuple(args, "O!O!O!O!f|i",
+			&PyArray_Type, &p_xRange,
+			&PyArray_Type, &p_yRange,
+			&PyArray_Type, &p_xReceive,
+			&PyArray_Type, &p_yReceive,
+			&lenR, &nThreads)) {
+    return NULL;
+  }
+  nx = PyArray_SIZE(p_xRange);
+  ny = PyArray_SIZE(p_yRange);
+  nSteps = PyArray_SIZE(p_xReceive);
+  if (!valid_float_vector(p_xRange, nx) ||
+      !valid_float_vector(p_yRange, ny) ||
+      !valid_float_vector(p_xReceive, nSteps) ||
+      !valid_float_vector(p_yReceive, nSteps)) {
+    PyErr_SetString(PyExc_ValueError, "pixel and receiver coordinates "
+		    "must be contiguous 1D arrays of float32");
+    return NULL;
+  }
+  dim_table[0] = nx;
+  dim_table[1] = ny;
+  dim_table[2] = nSteps;
+  p_cosAlpha = PyArray_ZEROS(3, dim_table, NPY_FLOAT32, 0);
+  p_tempc = PyArray_ZEROS(3, dim_table, NPY_FLOAT32, 0);
+
+  Py_BEGIN_ALLOW_THREADS
+  focal_line_precompute_imp
+    ((npy_float *)PyArray_DATA(p_xRange),
+     (npy_float *)PyArray_DATA(p_yRange),
+     (npy_float *)PyArray_DATA(p_xReceive),
+     (npy_float *)PyArray_DATA(p_yReceive),
+     nx, ny, nSteps, lenR, nThreads,
+     (npy_float *)PyArray_DATA((PyArrayObject *)p_cosAlpha),
+     (npy_float *)PyArray_DATA((PyArrayObject *)p_tempc));
+  Py_END_ALLOW_THREADS
+
+  return Py_BuildValue("NN", p_cosAlpha, p_tempc);
+}
+
+// focal-line backprojection of scanning planes, added to an image
+// inputs:
+//   img: numpy.ndarray, dtype=numpy.float32, size=[nPixelx,nPixely,nz],
+//        C-ordered, updated in place
+//   pa_data: numpy.ndarray, ndim=3, dtype=numpy.float32, Fortran-ordered,
+//            size=[nSamples,nLines,nPlanes]
+//   cosAlpha, tempc: tables returned by focal_line_precompute
+//   zRange: numpy.ndarray, ndim=1, dtype=numpy.float32, length=nz,
+//           ascending
+//   zReceive: numpy.ndarray, ndim=1, dtype=numpy.float32, z of each plane
+//   transducers: numpy.ndarray, dtype=numpy.int32, size=[nLines,nPlanes],
+//                Fortran-ordered, transducer of each line
+//   delayIdx: numpy.ndarray, ndim=1, dtype=numpy.float32, DAQ delay of
+//             each transducer
+//   lenR, vm, fs: float
+//   nThreads: (optional) int, number of threads (1 by default); the GIL
+//             is released while the loop runs
+static PyObject* focal_line_backproject(PyObject* self, PyObject* args) {
+  PyArrayObject *p_img, *p_pa_data, *p_cosAlpha, *p_tempc, *p_zRange,
+    *p_zReceive, *p_transducers, *p_delayIdx;
+  float lenR, vm, fs;
+  int nThreads = 1, nx, ny, nz, nSteps, nSamples, nLines, nPlanes;
+  npy_int32 *transducers;
+  npy_float *zRange;
+  npy_intp i;
+
+  if (!PyArg_ParseTuple(args, "O!O!O!O!O!O!O!O!fff|i",
+			&PyArray_Type, &p_img,
+			&PyArray_Type, &p_pa_data,
+			&PyArray_Type, &p_cosAlpha,
+			&PyArray_Type, &p_tempc,
+			&PyArray_Type, &p_zRange,
+			&PyArray_Type, &p_zReceive,
+			&PyArray_Type, &p_transducers,
+			&PyArray_Type, &p_delayIdx,
+			&lenR, &vm, &fs, &nThreads)) {
+    return NULL;
+  }
+  if (PyArray_NDIM(p_img) != 3 || PyArray_NDIM(p_cosAlpha) != 3 ||
+      PyArray_NDIM(p_pa_data) != 3) {
+    PyErr_SetString(PyExc_ValueError, "img, pa_data and the tables must "
+		    "be 3D arrays");
+    return NULL;
+  }
+  nx = PyArray_SHAPE(p_img)[0];
+  ny = PyArray_SHAPE(p_img)[1];
+  nz = PyArray_SHAPE(p_img)[2];
+  nSteps = PyArray_SHAPE(p_cosAlpha)[2];
+  nSamples = PyArray_SHAPE(p_pa_data)[0];
+  nLines = PyArray_SHAPE(p_pa_data)[1];
+  nPlanes = PyArray_SHAPE(p_pa_data)[2];
+  if (PyArray_TYPE(p_img) != NPY_FLOAT32 ||
+      !PyArray_CHKFLAGS(p_img, NPY_ARRAY_CARRAY) ||
+      PyArray_TYPE(p_pa_data) != NPY_FLOAT32 ||
+      !PyArray_CHKFLAGS(p_pa_data, NPY_ARRAY_FARRAY_RO) ||
+      PyArray_TYPE(p_cosAlpha) != NPY_FLOAT32 ||
+      !PyArray_CHKFLAGS(p_cosAlpha, NPY_ARRAY_CARRAY_RO) ||
+      !PyArray_SAMESHAPE(p_cosAlpha, p_tempc) ||
+      PyArray_TYPE(p_tempc) != NPY_FLOAT32 ||
+      !PyArray_CHKFLAGS(p_tempc, NPY_ARRAY_CARRAY_RO) ||
+      PyArray_SHAPE(p_cosAlpha)[0] != nx ||
+      PyArray_SHAPE(p_cosAlpha)[1] != ny ||
+      !valid_float_vector(p_zRange, nz) ||
+      !valid_float_vector(p_zReceive, nPlanes) ||
+      !valid_float_vector(p_delayIdx, nSteps) ||
+      PyArray_TYPE(p_transducers) != NPY_INT32 ||
+      !PyArray_CHKFLAGS(p_transducers, NPY_ARRAY_FARRAY_RO) ||
+      PyArray_SIZE(p_transducers) != (npy_intp)nLines * nPlanes) {
+    PyErr_SetString(PyExc_ValueError, "invalid focal-line backprojection "
+		    "arrays");
+    return NULL;
+  }
+  transducers = (npy_int32 *)PyArray_DATA(p_transducers);
+  for (i=0; i<PyArray_SIZE(p_transducers); i++) {
+    if (transducers[i] < 0 || transducers[i] >= nSteps) {
+      PyErr_SetString(PyExc_ValueError, "transducer index out of range");
+      return NULL;
+    }
+  }
+  zRange = (npy_float *)PyArray_DATA(p_zRange);
+  for (i=1; i<nz; i++) {
+    if (!(zRange[i] >= zRange[i-1])) {
+      PyErr_SetString(PyExc_ValueError, "zRange must be ascending");
+      return NULL;
+    }
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  focal_line_backproject_imp
+    ((npy_float *)PyArray_DATA(p_pa_data), nSamples, nLines, nPlanes,
+     (npy_float *)PyArray_DATA(p_cosAlpha),
+     (npy_float *)PyArray_DATA(p_tempc), zRange,
+     (npy_float *)PyArray_DATA(p_zReceive), transducers,
+     (npy_float *)PyArray_DATA(p_delayIdx),
+     nx, ny, nz, nSteps, lenR, vm, fs, nThreads,
+     (npy_float *)PyArray_DATA(p_img));
+  Py_END_ALLOW_THREADS
+
+  Py_RETURN_NONE;
+}
+
 static PyMethodDef ReconMethods[] = {
   {"recon_loop", recon_loop, METH_VARARGS, "Reconstruction loop"},
   {"find_index_map_and_angular_weight", find_index_map_and_angular_weight,
    METH_VARARGS, "Find index map and angular weights for back-projection"},
+  {"recon_on_the_fly", recon_on_the_fly, METH_VARARGS,
+   "Table-free reconstruction computing delays and weights on the fly"},
+  {"focal_line_precompute", focal_line_precompute, METH_VARARGS,
+   "cosAlpha and tempc tables of the focal-line backprojection"},
+  {"focal_line_backproject", focal_line_backproject, METH_VARARGS,
+   "Focal-line backprojection of scanning planes"},
   {NULL, NULL, 0, NULL} // the end
 };
 
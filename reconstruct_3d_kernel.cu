@@ -25,6 +25,28 @@ __global__ void calculate_cos_alpha_and_tempc
   tempc[idx] = rr0 - lenR/cosAlpha[idx];
 }
 
+// largest |dz| within the aperture of any transducer, over each pixel
+// column, at [yi + xi*ny]: a voxel farther than that from a scanning
+// plane gets nothing from its A-lines. The limit is rounded up, so that
+// it never culls a voxel passing the test of backprojection_kernel_fast.
+__global__ void calculate_dz_limit
+(float *dzLimit, float *cosAlpha_, float *tempc_, float lenR,
+ unsigned int nSteps) {
+  size_t xi = blockIdx.x;
+  size_t yi = blockIdx.y;
+  size_t col = yi + xi*gridDim.y;
+  double limit = 0.0;
+  for (unsigned int ni = 0; ni < nSteps; ni++) {
+    size_t precompIdx = ni + col*nSteps;
+    double window = fabs(10.0*tempc_[precompIdx]/lenR/cosAlpha_[precompIdx]);
+    // NaN windows disable the culling of the column
+    if (!(window <= limit)) {
+      limit = window;
+    }
+  }
+  dzLimit[col] = limit * 1.0001;
+}
+
 __global__ void backprojection_kernel_fast
 (float *img, float *paDataLine,
  float *cosAlpha_, float *tempc_, float *zRange,
@@ -47,3 +69,48 @@ __global__ void backprojection_kernel_fast
     }
   }
 }
+
+// backprojection_kernel_fast over nPlanes planes of nLines A-lines each,
+// uploaded together: line li of plane pi starts at
+// paData[lineLength*(li + nLines*pi)] and is the A-line of transducer
+// transducers[li + nLines*pi]. Every voxel sums planes, then lines, in
+// the same order as one backprojection_kernel_fast call per line.
+// Planes beyond dzLimit (see calculate_dz_limit) of the voxel are
+// skipped without visiting their lines.
+__global__ void backprojection_kernel_batch
+(float *img, float *paData,
+ float *cosAlpha_, float *tempc_, float *dzLimit_, float *zRange,
+ float *zReceive,
+ int *transducers, float *delayIdx, float lenR, float vm, float fs,
+ unsigned int nSteps, unsigned int lineLength,
+ unsigned int nLines, unsigned int nPlanes) {
+  size_t xi = blockIdx.x;
+  size_t yi = blockIdx.y;
+  size_t zi = threadIdx.x;
+  size_t imgIdx = zi + yi*blockDim.x + xi*blockDim.x*gridDim.y;
+  float value = img[imgIdx];
+  float dzLimit = dzLimit_[yi + xi*gridDim.y];
+  for (unsigned int pi = 0; pi < nPlanes; pi++) {
+    float dz = zRange[zi] - zReceive[pi];
+    if (fabs(dz) >= dzLimit) {
+      continue;
+    }
+    for (unsigned int li = 0; li < nLines; li++) {
+      unsigned int ni = transducers[li + nLines*pi];
+      float *paDataLine = paData + (size_t)lineLength*(li + nLines*pi);
+      size_t precompIdx = ni + yi*nSteps + xi*nSteps*gridDim.y;
+      float cosAlpha = cosAlpha_[precompIdx];
+      float tempc = tempc_[precompIdx];
+      // voxels outside the aperture skip the delay and weight
+      if (fabs(dz/tempc) < fabs(10.0/lenR/cosAlpha)) {
+        float rr0 = sqrt(tempc*tempc + dz*dz)*SIGN(tempc) + lenR/cosAlpha;
+        float angleWeightB = tempc/sqrt(tempc*tempc+dz*dz)*cosAlpha/(rr0*rr0);
+        size_t idx0 = lround((rr0/vm-delayIdx[ni])*fs);
+        if (idx0 < lineLength) {
+          value += paDataLine[idx0] / angleWeightB;
+        }
+      }
+    }
+  }
+  img[imgIdx] = value;
+}
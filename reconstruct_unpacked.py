@@ -1,21 +1,202 @@
 #!/usr/bin/env python
 
 import os
+import sys
 import argh
+import ctypes
+import multiprocessing
 import yaml
 import h5py
 import numpy as np
 from pact_helpers import *
-from recon_loop import recon_loop, find_index_map_and_angular_weight
+from recon_loop import recon_loop, recon_on_the_fly
+from geometry_cache import cached_index_map_and_angular_weight,\
+    cached_backprojection_operator, quantize_delay, table_dtypes
+from hierarchical_backprojection import HierarchicalBackprojector
+from unpack_data import lazy_channel_data
+from daq_decode import LazyChannelData
 from time import time
 from matplotlib import pyplot as plt
 from scipy.signal import hilbert
 from preprocess import subfunc_wiener, subfunc_exact
 
 
-def reconstruction_inline(chn_data_3d, reconOpts, progress=update_progress):
+def recon_threads(reconOpts):
+  """number of backprojection threads set by recon.threads, 0 for one
+  per CPU"""
+  nThreads = reconOpts.get('threads', 1)
+  if nThreads == 0:
+    nThreads = multiprocessing.cpu_count()
+  return nThreads
+
+def backprojection_engine(reconOpts, nPixels, nSteps, nSamples):
+  """backprojection engine set by recon.backprojection: loop, sparse,
+  table-free or auto. auto uses loop if its tables fit in
+  recon.table_memory_mb, and the table-free engine otherwise. The
+  hierarchical algorithm has its own engine."""
+  if reconOpts['algorithm'] == 'hierarchical':
+    return 'hierarchical'
+  engine = reconOpts.get('backprojection', 'loop')
+  if engine == 'auto':
+    idxDtype, weightDtype = table_dtypes(reconOpts, nSamples)
+    tableBytes = nPixels * nSteps * (idxDtype.itemsize +
+                                     weightDtype.itemsize)
+    budget = reconOpts.get('table_memory_mb', 2048) * 1024 * 1024
+    engine = 'loop' if tableBytes <= budget else 'table-free'
+  return engine
+
+def remove_dc(temp, meanBuf=None):
+  """remove the DC of samples 100 and after of a z step, in place
+  meanBuf: optional buffer of one value per detector"""
+  meanBuf = np.mean(temp[99:,:], axis=0, out=meanBuf)
+  temp[99:,:] -= meanBuf
+
+def prepare_slice(paData, z, temp, meanBuf, envelope):
+  """copy (or decode, for LazyChannelData) z step z of paData into the
+  Fortran-ordered buffer temp, extract its envelope if required, and
+  remove its DC"""
+  if envelope:
+    temp[...] = np.abs(hilbert(paData[:,:, z], axis=0))
+  else:
+    temp[...] = paData[:,:, z]
+  remove_dc(temp, meanBuf)
+
+def prepare_block(paData, z0, z1, block, meanBuf, envelope):
+  """prepare_slice of z steps [z0, z1) into the first z1 - z0 z steps of
+  block, returned as a view"""
+  block = block[:,:, 0:z1 - z0]
+  for z in range(z0, z1):
+    prepare_slice(paData, z, block[:,:, z - z0], meanBuf, envelope)
+  return block
+
+class SliceBackprojector:
+  """backprojection of ranges of z steps of paData into reImg with one
+  of the engines: loop, sparse, table-free or hierarchical. geometry is
+  (idxAll, angularWeight, totalAngularWeight) for loop, a
+  BackprojectionOperator for sparse, (xImg, yImg, xReceive, yReceive,
+  delayIdx, vm, fs) for table-free and a HierarchicalBackprojector for
+  hierarchical. Buffers are allocated on first use, i.e. in the process
+  that runs the backprojection.
+  """
+  def __init__(self, paData, reImg, engine, geometry, envelope, nThreads,
+               zBlock):
+    self.paData = paData
+    self.reImg = reImg
+    self.engine = engine
+    self.geometry = geometry
+    self.envelope = envelope
+    self.nThreads = nThreads
+    # the loop engine reconstructs one z step at a time
+    self.zStep = 1 if engine == 'loop' else zBlock
+    self.block = None
+
+  def ranges(self):
+    """list of (z0, z1) ranges run at once"""
+    zSteps = self.reImg.shape[2]
+    return [(z0, min(z0 + self.zStep, zSteps))
+            for z0 in range(0, zSteps, self.zStep)]
+
+  def allocate(self):
+    (nSamples, nSteps) = self.paData.shape[0:2]
+    (nPixely, nPixelx) = self.reImg.shape[0:2]
+    self.meanBuf = np.zeros(nSteps)
+    self.block = np.zeros((nSamples, nSteps, self.zStep), order='F')
+    self.imgBuf = np.zeros((nPixely, nPixelx), order='F')
+
+  def run(self, z0, z1):
+    """reconstruct z steps [z0, z1) into reImg[:,:, z0:z1]"""
+    if self.block is None:
+      self.allocate()
+    block = prepare_block(self.paData, z0, z1, self.block, self.meanBuf,
+                          self.envelope)
+    reImg = self.reImg[:,:, z0:z1]
+    if self.engine in ('sparse', 'hierarchical'):
+      self.geometry.apply(block, out=reImg)
+    elif self.engine == 'table-free':
+      (paImg, totalAngularWeight) = recon_on_the_fly\
+          (block, *(self.geometry + (self.nThreads,)))
+      np.divide(paImg, totalAngularWeight[:,:, np.newaxis], out=reImg)
+    else:
+      (idxAll, angularWeight, totalAngularWeight) = self.geometry
+      (nPixely, nPixelx, nSteps) = idxAll.shape
+      paImg = recon_loop(block[:,:, 0], idxAll, angularWeight,
+                         nPixelx, nPixely, nSteps, self.nThreads,
+                         self.imgBuf)
+      if paImg is None:
+        notifyCli('WARNING: None returned as 2D reconstructed image!')
+      np.divide(paImg, totalAngularWeight, out=reImg[:,:, 0])
+
+def recon_processes(reconOpts):
+  """number of processes reconstructing z steps set by recon.processes,
+  0 for one per CPU. Worker processes are forked, so they are not used
+  on Windows."""
+  nProcesses = reconOpts.get('processes', 1)
+  if nProcesses == 0:
+    nProcesses = multiprocessing.cpu_count()
+  if sys.platform == 'win32':
+    nProcesses = 1
+  return nProcesses
+
+def shared_zeros(shape):
+  """zero-filled, Fortran-ordered array of doubles in shared memory, so
+  that forked worker processes write into the parent's array"""
+  buf = multiprocessing.RawArray(ctypes.c_double, int(np.prod(shape)))
+  return np.ctypeslib.as_array(buf).reshape(shape, order='F')
+
+# backprojector of the running backproject_parallel, inherited by the
+# forked workers together with the channel data and geometry it refers
+# to, none of which is pickled
+_backprojector = None
+
+def _init_backproject_worker():
+  """initializer of the backproject_parallel workers: lazy channel data
+  (possibly decimated) decodes on one thread, as worker processes
+  replace threads"""
+  paData = _backprojector.paData
+  while isinstance(paData, DecimatedChannelData):
+    paData = paData.paData
+  if isinstance(paData, LazyChannelData):
+    paData.set_threads(1)
+
+def _backproject_range(zRange):
+  """worker function of backproject_parallel"""
+  _backprojector.run(*zRange)
+  return zRange[1] - zRange[0]
+
+def backproject_parallel(backprojector, nProcesses, progress):
+  """run backprojector over all its z ranges on nProcesses worker
+  processes; its reImg must be in shared memory (see shared_zeros).
+  progress is called in this process as z steps complete."""
+  global _backprojector
+  _backprojector = backprojector
+  zSteps = backprojector.reImg.shape[2]
+  pool = multiprocessing.Pool(nProcesses, _init_backproject_worker)
+  try:
+    done = 0
+    for count in pool.imap_unordered(_backproject_range,
+                                     backprojector.ranges()):
+      done += count
+      progress(done, zSteps)
+  finally:
+    pool.close()
+    pool.join()
+    _backprojector = None
+
+def calibrate_delay(paData, fs, envelope):
+  """DAQ delay of each detector, from the first z step of paData"""
+  firstStep = paData[:,:, 0]
+  if envelope:
+    firstStep = np.abs(hilbert(firstStep, axis=0))
+  return find_delay_idx(firstStep, fs)
+
+def reconstruction_inline(chn_data_3d, reconOpts, progress=update_progress,
+                          delayIdx=None, detectorStep=1):
   """reconstruction function re-implemented according to
   subfunc_reconstruction2_inline.m
+  delayIdx: DAQ delay of each detector, calibrated from the first z step
+            if None
+  detectorStep: chn_data_3d holds every detectorStep-th detector of the
+                ring
   """
   iniAngle = reconOpts['ini_angle']
   vm = reconOpts['V_M']
@@ -29,11 +210,12 @@ def reconstruction_inline(chn_data_3d, reconOpts, progress=update_progress):
   # paData = np.copy(chn_data_3d[0:1300,:,:]) # cropping the first 1300
   paData = chn_data_3d
   algorithm = reconOpts['algorithm']
-  if algorithm == 'envelope':
+  # envelopes are extracted one z step at a time in prepare_slice
+  envelope = algorithm == 'envelope'
+  if envelope:
     notifyCli('Extracting envelope of A-line signals')
-    paData = np.abs(hilbert(paData, axis=0))
   (nSamples, nSteps, zSteps) = chn_data_3d.shape
-  if nSteps != 512:
+  if nSteps * detectorStep != 512:
     notifyCli('ERROR: Number of transducers should be 512!')
     return None
   totalSteps = nSteps
@@ -55,40 +237,149 @@ def reconstruction_inline(chn_data_3d, reconOpts, progress=update_progress):
       * anglePerStep + angleStep1
   xReceive = np.cos(detectorAngle) * R
   yReceive = np.sin(detectorAngle) * R
+  if delayIdx is None:
+    # use the first z step data to calibrate DAQ delay
+    delayIdx = calibrate_delay(paData, fs, envelope)
+  engine = backprojection_engine(reconOpts, nPixelx * nPixely, nSteps,
+                                nSamples)
+  nThreads = recon_threads(reconOpts)
+  nProcesses = recon_processes(reconOpts)
+  if nProcesses > 1:
+    # worker processes replace threads
+    nThreads = 1
+  if engine == 'table-free':
+    delayIdx = quantize_delay(delayIdx, fs,
+                              reconOpts.get('delay_quantization', 0))
+    geometry = (xImg, yImg, xReceive, yReceive, delayIdx, vm, fs)
+  elif engine == 'hierarchical':
+    notifyCli('Building hierarchical backprojection grids')
+    delayIdx = quantize_delay(delayIdx, fs,
+                              reconOpts.get('delay_quantization', 0))
+    levels = reconOpts.get('hierarchical_levels', -1)
+    geometry = HierarchicalBackprojector\
+        (xImg, yImg, xReceive, yReceive, delayIdx, vm, fs, nSamples,
+         reconOpts.get('hierarchical_oversampling', 2.0),
+         None if levels < 0 else levels)
+  else:
+    # find index map and angular weighting for backprojection
+    notifyCli('Calculating geometry dependent backprojection'
+              'parameters')
+    if engine == 'sparse':
+      geometry = cached_backprojection_operator\
+          (nSteps, xImg, yImg, xReceive, yReceive, delayIdx, vm, fs,
+           nSamples, reconOpts)
+    else:
+      geometry = cached_index_map_and_angular_weight\
+          (nSteps, xImg, yImg, xReceive, yReceive, delayIdx, vm, fs,
+           nSamples, reconOpts)
   # reconstructed image buffer
-  reImg = np.zeros((nPixely, nPixelx, zSteps), order='F')
-  # use the first z step data to calibrate DAQ delay
-  delayIdx = find_delay_idx(paData[:,:, 0], fs)
-  # find index map and angular weighting for backprojection
-  notifyCli('Calculating geometry dependent backprojection'
-            'parameters')
-  (idxAll, angularWeight, totalAngularWeight)\
-      = find_index_map_and_angular_weight\
-      (nSteps, xImg, yImg, xReceive, yReceive, delayIdx, vm, fs)
-  idxAll[idxAll > nSamples] = 1
+  if nProcesses > 1:
+    reImg = shared_zeros((nPixely, nPixelx, zSteps))
+  else:
+    reImg = np.zeros((nPixely, nPixelx, zSteps), order='F')
+  backprojector = SliceBackprojector(paData, reImg, engine, geometry,
+                                     envelope, nThreads,
+                                     reconOpts.get('z_block', 16))
   # backprojection
   notifyCli('Backprojection starts...')
-  for z in range(zSteps):
-    # remove DC
-    paDataDC = np.dot(np.ones((nSamples - 99, 1)),
-                      np.mean(paData[99:nSamples,:, z],
-                              axis=0).reshape((1, paData.shape[1])))
-    paData[99:nSamples,:, z] = paData[99:nSamples,:, z] - paDataDC
-    temp = np.copy(paData[:,:, z], order = 'F')
-    paImg = recon_loop(temp, idxAll, angularWeight,
-                       nPixelx, nPixely, nSteps)
-    if paImg == None:
-      notifyCli('WARNING: None returned as 2D reconstructed image!')
-    paImg = paImg / totalAngularWeight
-    reImg[:,:, z] = paImg
-    # notifyCli(str(z)+'/'+str(zSteps))
-    progress(z + 1, zSteps)
+  if nProcesses > 1:
+    backproject_parallel(backprojector, nProcesses, progress)
+  else:
+    for (z0, z1) in backprojector.ranges():
+      backprojector.run(z0, z1)
+      progress(z1, zSteps)
+  return reImg
+
+def average_samples(aLines, factor):
+  """A-lines averaged over blocks of factor samples, i.e. sampled at
+  fs / factor"""
+  nSamples = aLines.shape[0] // factor
+  return aLines[0:nSamples * factor].reshape\
+      ((factor, nSamples, aLines.shape[1]), order='F').mean(axis=0)
+
+class DecimatedChannelData:
+  """every factor-th detector of channel data (e.g. chn_data_3d or a
+  LazyChannelData) with A-lines averaged by average_samples, or their
+  envelopes if envelope is set, one z step at a time. Only [:,:, z]
+  indexing with an integer z is supported, which is what
+  reconstruction_inline uses."""
+  def __init__(self, paData, factor, envelope=False):
+    self.paData = paData
+    self.factor = factor
+    self.envelope = envelope
+    (nSamples, nSteps, zSteps) = paData.shape
+    self.shape = (nSamples // factor, nSteps // factor, zSteps)
+    self.ndim = 3
+    self.dtype = np.dtype(np.double)
+
+  def __getitem__(self, key):
+    (samples, steps, z) = key
+    aLines = self.paData[:,:, z][:, ::self.factor]
+    if self.envelope:
+      # at the full sampling rate, before averaging
+      aLines = np.abs(hilbert(aLines, axis=0))
+    return average_samples(aLines, self.factor)[samples, steps]
+
+def reconstruction_preview(chn_data_3d, reconOpts, preview,
+                           progress=update_progress):
+  """reconstruction_inline preceded by coarse previews of the same data
+  recon.preview_stages lists decimation factors, e.g. [4, 2]. The stage
+  of factor f reconstructs at resolution_factor / f from every f-th
+  detector and A-lines averaged down to fs / f, at about 1 / f^3 of the
+  cost of the full reconstruction, which is the last stage. Previews are
+  reconstructed from envelopes, as the coarse pixels and samples cannot
+  resolve the oscillations of the A-lines.
+  preview(image, stage, nStages) is called with the image of each stage
+  and progress covers all stages. Returns the full reconstruction.
+  """
+  factors = [f for f in reconOpts.get('preview_stages', []) if f > 1]
+  if [f for f in factors if 512 % f]:
+    notifyCli('WARNING: preview stages should divide 512, skipped')
+    factors = []
+  factors.append(1)
+  nStages = len(factors)
+  fs = reconOpts['fs']
+  delayIdx = calibrate_delay(chn_data_3d, fs,
+                             reconOpts['algorithm'] == 'envelope')
+  for stage, factor in enumerate(factors):
+    stageProgress = lambda current, total, stage=stage:\
+        progress(stage * total + current, nStages * total)
+    if factor == 1:
+      reImg = reconstruction_inline(chn_data_3d, reconOpts, stageProgress,
+                                    delayIdx)
+    else:
+      opts = dict(reconOpts)
+      opts['resolution_factor'] =\
+          float(reconOpts['resolution_factor']) / factor
+      opts['fs'] = float(fs) / factor
+      # envelopes are extracted by DecimatedChannelData
+      opts['algorithm'] = 'delay-and-sum'
+      # samples averaged over a block are centered (factor - 1) / 2
+      # samples before the last one
+      reImg = reconstruction_inline\
+          (DecimatedChannelData(chn_data_3d, factor, True), opts,
+           stageProgress, delayIdx[::factor] - (factor - 1) / (2.0 * fs),
+           factor)
+    if reImg is None:
+      return None
+    preview(reImg, stage + 1, nStages)
   return reImg
 
+def load_channel_data(opts, ind):
+  """load channel data of an index from chndata_<ind>.h5 or, if
+  load.lazy is set, straight from the raw data files. In the latter
+  case chn_data_3d is a LazyChannelData decoding z steps on demand
+  and chn_data is None (see LazyChannelData.average)."""
+  if opts['load'].get('lazy', False):
+    return None, lazy_channel_data(opts, ind)
+  return load_hdf5_data(opts['extra']['dest_dir'], ind)
+
 def reconstruct_2d_average(opts, progress=update_progress):
   dest_dir = opts['extra']['dest_dir']
   ind = opts['load']['EXP_START']
-  chn_data, chn_data_3d = load_hdf5_data(dest_dir, ind)
+  chn_data, chn_data_3d = load_channel_data(opts, ind)
+  if chn_data is None:
+    chn_data = chn_data_3d.average()
   if opts['display']['wi']:
     notifyCli('Performing Weiner deconvolution...')
     chn_data = subfunc_wiener(chn_data)
@@ -101,17 +392,28 @@ def reconstruct_2d_average(opts, progress=update_progress):
   save_reconstructed_image(reImg, dest_dir, ind, out_format)
   return reImg
 
-def reconstruct_2d(opts, progress=update_progress):
+def reconstruct_2d(opts, progress=update_progress, preview=None):
+  """reconstruct every z step of an index, after coarse previews passed
+  to preview if it is given and recon.preview_stages is not empty (see
+  reconstruction_preview)"""
   dest_dir = opts['extra']['dest_dir']
   ind = opts['load']['EXP_START']
-  chn_data, chn_data_3d = load_hdf5_data(dest_dir, ind)
+  chn_data, chn_data_3d = load_channel_data(opts, ind)
+  if opts['display']['wi'] or opts['display']['exact']:
+    # pre-processing works on the whole array
+    chn_data_3d = np.asfortranarray(chn_data_3d)
   if opts['display']['wi']:
     notifyCli('Performing Weiner deconvolution...')
     chn_data_3d = subfunc_wiener(chn_data_3d)
   if opts['display']['exact']:
     notifyCli('Performing filtering...')
     chn_data_3d = subfunc_exact(chn_data_3d)
-  reImg = reconstruction_inline(chn_data_3d, opts['recon'], progress=progress)
+  if preview is None or not opts['recon'].get('preview_stages'):
+    reImg = reconstruction_inline(chn_data_3d, opts['recon'],
+                                  progress=progress)
+  else:
+    reImg = reconstruction_preview(chn_data_3d, opts['recon'], preview,
+                                   progress=progress)
   out_format = opts['recon']['out_format']
   save_reconstructed_image(reImg, dest_dir, ind, out_format)
   return reImg
@@ -2,49 +2,325 @@
 
 import os
 import argh
+import h5py
 import numpy as np
 from time import time
 from pact_helpers import notifyCli, loadOptions
 from pact_helpers import find_delay_idx, load_hdf5_data
-from pact_helpers import save_reconstructed_image
+from pact_helpers import save_reconstructed_image, get_directory_index
 from pact_helpers import update_progress_with_time
 from preprocess import subfunc_wiener, subfunc_exact
+from unpack_data import lazy_channel_data
+from reconstruct_unpacked import recon_threads
+from recon_loop import focal_line_precompute, focal_line_backproject
 
-import pycuda.driver as cuda
-from pycuda.compiler import SourceModule
-from StringIO import StringIO
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+KERNEL_CU_FILE = os.path.join(MODULE_DIR, 'reconstruct_3d_kernel.cu')
+PULSE_FILE = os.path.join(MODULE_DIR, 'PULSE_ARRANGEMENTS.txt')
+_pulseList = None
 
-KERNEL_CU_FILE = 'reconstruct_3d_kernel.cu'
-PULSE_STR = ""
-PULSE_FILE = 'PULSE_ARRANGEMENTS.txt'
-with open(PULSE_FILE) as fid:
-    PULSE_STR = fid.read()
 
+def pulse_list():
+    """firing order read from PULSE_FILE on first use: transducers
+    (0-start indices) of each firing group, (numGroup, nSteps / numGroup);
+    the array is shared and read-only"""
+    global _pulseList
+    if _pulseList is None:
+        # pulse list was created based on MATLAB's 1-starting index
+        # minus 1 to correct for the 0-starting index in Python
+        pulseList = np.loadtxt(PULSE_FILE, dtype=np.int) - 1
+        pulseList.setflags(write=False)
+        _pulseList = pulseList
+    return _pulseList
 
-def rearrange_pa_data(paData):
-    """rearrange paData array according to 8 firing order
+
+def rearrange_pa_data(paData, inPlace=False):
+    """rearrange paData array according to 8 firing order into float32
+    planes, one per firing group and z step, gathering a z step at a time
+    inPlace: store the planes in the memory of paData, which is
+             overwritten, so that the data are never held twice; paData
+             must then be a writable, Fortran-ordered float32 or float64
+             array
     """
     nSamples, nSteps, zSteps = paData.shape
     assert nSteps == 512
-    # load pulse list from the pre-defined string
-    sio = StringIO(PULSE_STR)
-    pulseList = np.loadtxt(sio, dtype=np.int)
-    # pulse list was created based on MATLAB's 1-starting index
-    # minus 1 to correct for the 0-starting index in Python
-    pulseList = pulseList - 1
-    numGroup = pulseList.shape[0]
-    paDataE = np.zeros((nSamples, nSteps / numGroup, zSteps * numGroup),
-                       dtype=np.float32, order='F')
+    pulseList = pulse_list()
+    numGroup, nLines = pulseList.shape
+    shape = (nSamples, nLines, zSteps * numGroup)
+    if inPlace and not (isinstance(paData, np.ndarray) and
+                        paData.flags.f_contiguous and
+                        paData.flags.writeable and
+                        paData.dtype in (np.float32, np.float64)):
+        notifyCli('WARNING: paData cannot be rearranged in place. '
+                  'Copying it instead.')
+        inPlace = False
+    if inPlace:
+        # the planes of z step zi only overwrite z steps up to zi, which
+        # have been gathered already
+        paDataE = paData.reshape(-1, order='F').view(np.float32)\
+            [0:np.prod(shape)].reshape(shape, order='F')
+    else:
+        paDataE = np.empty(shape, dtype=np.float32, order='F')
+    # line li + nLines * fi of the planes of a z step is transducer
+    # pulseList[fi, li]; A-lines are rows of the transposed arrays
+    lineIdx = pulseList.ravel()
     for zi in range(zSteps):
-        for fi in range(numGroup):
-            paDataE[:, :, zi * numGroup + fi] = paData[:, pulseList[fi, :], zi]
+        planes = paDataE[:, :, zi * numGroup:(zi + 1) * numGroup]
+        planes.reshape((nSamples, nSteps), order='F').T[...] =\
+            np.asarray(paData[:, :, zi]).T[lineIdx]
     return paDataE, pulseList, numGroup
 
 
-def reconstruction_3d_stational(paData, reconOpts,
-                                progress=update_progress_with_time):
+def focal_line_backend(reconOpts):
+    """backend of the focal-line reconstruction set by recon.backend_3d:
+    cpu, cuda or auto, which uses cuda if pycuda finds a device"""
+    backend = reconOpts.get('backend_3d', 'auto')
+    if backend == 'auto':
+        try:
+            import pycuda.driver as cuda
+            cuda.init()
+            backend = 'cuda' if cuda.Device.count() > 0 else 'cpu'
+        except Exception:
+            backend = 'cpu'
+    return backend
+
+
+def cuda_context():
+    """initialize pycuda properly and return a context on the first
+    device"""
+    import pycuda.driver as cuda
+    cuda.init()
+    dev = cuda.Device(0)
+    return dev.make_context()
+
+
+class CpuFocalLineBackend:
+    """focal-line backprojection into reImg with the compiled,
+    multithreaded counterparts of the CUDA kernels"""
+    def __init__(self, reImg, xRange, yRange, zRange, xReceive, yReceive,
+                 delayIdx, lenR, vm, fs, nThreads):
+        self.reImg = reImg
+        self.zRange = zRange
+        self.delayIdx = delayIdx
+        self.lenR = lenR
+        self.vm = vm
+        self.fs = fs
+        self.nThreads = nThreads
+        self.cosAlpha, self.tempc = focal_line_precompute\
+            (xRange, yRange, xReceive, yReceive, lenR, nThreads)
+        # same memory layout as the image of the CUDA kernels
+        nPixely, nPixelx, nPixelz = reImg.shape
+        self.img = reImg.reshape((nPixelx, nPixely, nPixelz))
+
+    def backproject(self, paData, zReceive, transducers):
+        """add planes of A-lines to the image
+        paData: float32, Fortran-ordered (nSamples, nLines, nPlanes)
+        zReceive: z of each plane
+        transducers: int32, Fortran-ordered (nLines, nPlanes) transducer
+                     of each line
+        """
+        focal_line_backproject(self.img, paData, self.cosAlpha, self.tempc,
+                               self.zRange, zReceive, transducers,
+                               self.delayIdx, self.lenR, self.vm, self.fs,
+                               self.nThreads)
+
+    def result(self):
+        return self.reImg
+
+
+class CudaFocalLineBackend:
+    """focal-line backprojection into reImg with the kernels of
+    reconstruct_3d_kernel.cu, in the pycuda context ctx; see
+    CpuFocalLineBackend"""
+    def __init__(self, reImg, xRange, yRange, zRange, xReceive, yReceive,
+                 delayIdx, lenR, vm, fs, ctx):
+        import pycuda.driver as cuda
+        from pycuda.compiler import SourceModule
+        self.cuda = cuda
+        self.reImg = reImg
+        self.lenR = lenR
+        self.vm = vm
+        self.fs = fs
+        nPixely, nPixelx, nPixelz = reImg.shape
+        self.nSteps = len(xReceive)
+        # create buffer on GPU for reconstructed image
+        self.d_reImg = cuda.to_device(reImg)
+        self.d_cosAlpha = cuda.mem_alloc(nPixely * nPixelx * self.nSteps * 4)
+        self.d_tempc = cuda.mem_alloc(nPixely * nPixelx * self.nSteps * 4)
+        self.d_dzLimit = cuda.mem_alloc(nPixely * nPixelx * 4)
+        self.d_zRange = cuda.to_device(zRange)
+        self.d_delayIdx = cuda.to_device(delayIdx)
+        # batch buffers, grown on demand
+        self.d_paData = None
+        self.paDataBytes = 0
+        # get module right before execution of function
+        MOD = SourceModule(open(KERNEL_CU_FILE, 'r').read())
+        precomp = MOD.get_function('calculate_cos_alpha_and_tempc')
+        dzLimit = MOD.get_function('calculate_dz_limit')
+        self.bpk = MOD.get_function('backprojection_kernel_batch')
+        # compute cosAlpha and tempc
+        precomp(self.d_cosAlpha, self.d_tempc, cuda.In(xRange),
+                cuda.In(yRange), cuda.In(xReceive), cuda.In(yReceive),
+                np.float32(lenR),
+                grid=(nPixelx, nPixely), block=(self.nSteps, 1, 1))
+        # aperture of each pixel column, to skip planes out of its reach
+        dzLimit(self.d_dzLimit, self.d_cosAlpha, self.d_tempc,
+                np.float32(lenR), np.uint32(self.nSteps),
+                grid=(nPixelx, nPixely), block=(1, 1, 1))
+        ctx.synchronize()
+
+    def backproject(self, paData, zReceive, transducers):
+        """add planes of A-lines to the image with one upload and one
+        kernel call (see CpuFocalLineBackend.backproject)"""
+        cuda = self.cuda
+        nSamples, nLines, nPlanes = paData.shape
+        nPixely, nPixelx, nPixelz = self.reImg.shape
+        if paData.nbytes > self.paDataBytes:
+            self.d_paData = cuda.mem_alloc(paData.nbytes)
+            self.paDataBytes = paData.nbytes
+        cuda.memcpy_htod(self.d_paData, paData)
+        self.bpk(self.d_reImg, self.d_paData, self.d_cosAlpha, self.d_tempc,
+                 self.d_dzLimit, self.d_zRange, cuda.In(zReceive),
+                 cuda.In(transducers), self.d_delayIdx,
+                 np.float32(self.lenR), np.float32(self.vm),
+                 np.float32(self.fs), np.uint32(self.nSteps),
+                 np.uint32(nSamples), np.uint32(nLines), np.uint32(nPlanes),
+                 grid=(nPixelx, nPixely), block=(nPixelz, 1, 1))
+
+    def result(self):
+        self.cuda.memcpy_dtoh(self.reImg, self.d_reImg)
+        return self.reImg
+
+
+def create_focal_line_backend(ctx, reImg, xRange, yRange, zRange, xReceive,
+                              yReceive, delayIdx, lenR, vm, fs, nThreads):
+    """CudaFocalLineBackend in the pycuda context ctx, or
+    CpuFocalLineBackend on nThreads threads if ctx is None"""
+    if ctx is None:
+        backend = CpuFocalLineBackend(reImg, xRange, yRange, zRange,
+                                      xReceive, yReceive, delayIdx, lenR,
+                                      vm, fs, nThreads)
+    else:
+        backend = CudaFocalLineBackend(reImg, xRange, yRange, zRange,
+                                       xReceive, yReceive, delayIdx, lenR,
+                                       vm, fs, ctx)
+    notifyCli('Done pre-computing cosAlpha and tempc.')
+    return backend
+
+
+def backproject_planes(backend, paData, zReceive, pulseList, planesPerCall,
+                       progress):
+    """submit the planes (last axis) of paData to a focal-line backend,
+    planesPerCall planes at a time, and return the image; plane zi holds
+    the lines of the transducers pulseList[zi % numGroup]"""
+    nSamples, nLines, zSteps = paData.shape
+    numGroup = pulseList.shape[0]
+    # transducer of each line, per firing group
+    transducers = np.asfortranarray(pulseList.T, dtype=np.int32)
+    st = time()
+    for z0 in range(0, zSteps, planesPerCall):
+        z1 = min(z0 + planesPerCall, zSteps)
+        # convert (or decode, for LazyChannelData) the planes to single
+        paDataZ = np.asfortranarray(paData[:, :, z0:z1], dtype=np.float32)
+        groups = np.arange(z0, z1) % numGroup
+        backend.backproject(paDataZ, zReceive[z0:z1],
+                            np.asfortranarray(transducers[:, groups]))
+        et = time()
+        # use the execution time so far to guess the remaining time
+        time_remaining = ((zSteps - z1) * (et - st) / z1) / 60.0
+        progress(z1, zSteps, time_remaining)
+    return backend.result()
+
+
+def slab_width(reconOpts, nPixely, nPixelz, nSteps):
+    """x columns per slab of the out-of-core reconstruction, so that the
+    image and the cosAlpha and tempc tables of a slab fit in
+    recon.slab_memory_mb"""
+    columnBytes = nPixely * (nPixelz + 2 * nSteps) * 4
+    budget = reconOpts.get('slab_memory_mb', 1024) * 1024 * 1024
+    return max(1, int(budget // columnBytes))
+
+
+def write_slab(dataset, reImg, x0, x1):
+    """write the slab of x columns x0 to x1 into dataset
+    The backends fill images x column by x column, so the z lines of the
+    slab follow those of the previous slabs in the memory of the
+    in-memory image, whose shape is the (nPixely, nPixelx, nPixelz) of
+    dataset. They are copied one row of dataset at a time."""
+    nRows, nCols, nPixelz = dataset.shape
+    lines = reImg.reshape((-1, nPixelz))
+    l0 = x0 * nRows
+    l1 = x1 * nRows
+    for row in range(l0 // nCols, (l1 - 1) // nCols + 1):
+        c0 = max(l0, row * nCols)
+        c1 = min(l1, (row + 1) * nCols)
+        dataset[row, c0 - row * nCols:c1 - row * nCols] =\
+            lines[c0 - l0:c1 - l0]
+
+
+def backproject_volume(ctx, paData, xRange, yRange, zRange, xReceive,
+                       yReceive, zReceive, delayIdx, lenR, vm, fs, pulseList,
+                       planesPerCall, reconOpts, progress, outFile=None):
+    """focal-line reconstruction of paData (see backproject_planes) into
+    an image of xRange, yRange and zRange
+    outFile: None to return the whole image, or an open HDF5 file to
+             reconstruct slabs of x columns sized by slab_width, each with
+             its own tables, into its chunked 'reImg' dataset, which is
+             returned. The dataset has the shape (nPixely, nPixelx,
+             nPixelz) and the content of the in-memory image. The data are
+             read once per slab.
+    """
+    nPixelx, nPixely, nPixelz = len(xRange), len(yRange), len(zRange)
+    nThreads = recon_threads(reconOpts)
+    if outFile is None:
+        reImg = np.zeros((nPixely, nPixelx, nPixelz), order='C',
+                         dtype=np.float32)
+        # the in-plane terms are computed once for all z steps
+        backend = create_focal_line_backend(ctx, reImg, xRange, yRange,
+                                            zRange, xReceive, yReceive,
+                                            delayIdx, lenR, vm, fs, nThreads)
+        return backproject_planes(backend, paData, zReceive, pulseList,
+                                  planesPerCall, progress)
+    width = slab_width(reconOpts, nPixely, nPixelz, len(xReceive))
+    nSlabs = (nPixelx + width - 1) // width
+    dataset = outFile.create_dataset('reImg', (nPixely, nPixelx, nPixelz),
+                                     dtype=np.float32,
+                                     chunks=(1, nPixelx, nPixelz))
+    notifyCli('Reconstructing {:d} slabs of {:d} x columns'
+              .format(nSlabs, width))
+    st = time()
+    for si in range(nSlabs):
+        x0 = si * width
+        x1 = min(x0 + width, nPixelx)
+        reImg = np.zeros((nPixely, x1 - x0, nPixelz), order='C',
+                         dtype=np.float32)
+        backend = create_focal_line_backend(ctx, reImg, xRange[x0:x1],
+                                            yRange, zRange, xReceive,
+                                            yReceive, delayIdx, lenR, vm, fs,
+                                            nThreads)
+
+        def slab_progress(current, total, time_remaining, si=si):
+            done = si * total + current
+            time_remaining = ((nSlabs * total - done)
+                              * (time() - st) / done) / 60.0
+            progress(done, nSlabs * total, time_remaining)
+        reImg = backproject_planes(backend, paData, zReceive, pulseList,
+                                   planesPerCall, slab_progress)
+        write_slab(dataset, reImg, x0, x1)
+        # release the slab and its tables before the next one
+        del backend, reImg
+    return dataset
+
+
+def reconstruction_3d_stational(paData, reconOpts, ctx=None,
+                                progress=update_progress_with_time,
+                                outFile=None):
     """3D reconstruction algorithm for stational scanning
     see Jun's focal-line reconstruction paper and codes for details
+    ctx: pycuda context to reconstruct on the GPU, None to reconstruct on
+         recon.threads CPU threads
+    outFile: open HDF5 file to reconstruct slab by slab into, see
+             backproject_volume
     """
     # reading parameters from option dict
     lenR = reconOpts['Len_R']
@@ -83,49 +359,31 @@ def reconstruction_3d_stational(paData, reconOpts,
     xReceive = np.cos(detectorAngle) * R
     yReceive = np.sin(detectorAngle) * R
     zReceive = np.arange(0, zSteps, dtype=np.float32) * zPerStep
-    # create buffer on GPU for reconstructed image
-    reImg = np.zeros((nPixely, nPixelx, nPixelz), order='C', dtype=np.float32)
-    d_reImg = cuda.mem_alloc(nPixely * nPixelx * nPixelz * 4)
-    cuda.memcpy_htod(d_reImg, reImg)
     # back projection loop
     notifyCli('Reconstruction starting. Keep patient.')
-    d_xRange = cuda.mem_alloc(xRange.nbytes)
-    cuda.memcpy_htod(d_xRange, xRange)
-    d_yRange = cuda.mem_alloc(yRange.nbytes)
-    cuda.memcpy_htod(d_yRange, yRange)
-    d_zRange = cuda.mem_alloc(zRange.nbytes)
-    cuda.memcpy_htod(d_zRange, zRange)
-    # get module right before execution of function
-    MOD = SourceModule(open(KERNEL_CU_FILE, 'r').read())
-    bpk = MOD.get_function('backprojection_kernel')
-    d_paDataLine = cuda.mem_alloc(nSamples * 4)
-    # convert to single
-    paData = paData.astype(np.float32)
     st_all = time()
-    for zi in range(zSteps):
-        for ni in range(nSteps):
-            # print ni
-            cuda.memcpy_htod(d_paDataLine, paData[:, ni, zi])
-            bpk(d_reImg, d_paDataLine, d_xRange, d_yRange, d_zRange,
-                xReceive[ni], yReceive[ni], zReceive[zi],
-                np.float32(lenR), np.float32(vm), delayIdx[ni],
-                np.float32(fs), np.uint32(nSamples),
-                grid=(nPixelx, nPixely), block=(nPixelz, 1, 1))
-        et = time()
-        # use the execution time of the last loop to guess the remaining time
-        time_remaining = ((zSteps - zi + 1) * (et - st_all) / (zi + 1)) / 60.0
-        progress(zi + 1, zSteps, time_remaining)
-    cuda.memcpy_dtoh(reImg, d_reImg)
+    # every z step fires all transducers, in order, and is submitted at
+    # once
+    pulseList = np.arange(nSteps).reshape((1, nSteps))
+    reImg = backproject_volume(ctx, paData, xRange, yRange, zRange,
+                               xReceive, yReceive, zReceive, delayIdx, lenR,
+                               vm, fs, pulseList, 1, reconOpts, progress,
+                               outFile)
     et_all = time()
     notifyCli(
         'Total time elapsed: {:.2f} mins'.format((et_all - st_all) / 60.0))
     return reImg
 
 
-def reconstruction_3d(paData, reconOpts, ctx,
-                      progress=update_progress_with_time):
+def reconstruction_3d(paData, reconOpts, ctx=None,
+                      progress=update_progress_with_time,
+                      outFile=None):
     """3D reconstruction algorithm
     see Jun's focal-line reconstruction paper and codes for details
+    ctx: pycuda context to reconstruct on the GPU, None to reconstruct on
+         recon.threads CPU threads
+    outFile: open HDF5 file to reconstruct slab by slab into, see
+             backproject_volume
     """
     # reading parameters from option dict
     lenR = reconOpts['Len_R']
@@ -146,9 +404,8 @@ def reconstruction_3d(paData, reconOpts, ctx,
     delayIdx = delayIdx.astype(np.float32)
     # rearrange paData array according to firing order
     notifyCli('Re-arranging raw RF data according to firing squence')
-    # DEBUGGING
-    paData = paData.astype(np.float32)
-    paData, pulseList, numGroup = rearrange_pa_data(paData)
+    paData, pulseList, numGroup = rearrange_pa_data(
+        paData, reconOpts.get('rearrange_in_place', False))
     nSamples, nSteps, zSteps = paData.shape
     # notice the z step size is divided by firing group count
     zPerStep = zPerStep / numGroup
@@ -172,104 +429,108 @@ def reconstruction_3d(paData, reconOpts, ctx,
     xReceive = np.cos(detectorAngle) * R
     yReceive = np.sin(detectorAngle) * R
     zReceive = np.arange(0, zSteps, dtype=np.float32) * zPerStep
-    # create buffer on GPU for reconstructed image
-    reImg = np.zeros((nPixely, nPixelx, nPixelz),
-                     order='C', dtype=np.float32)
-    d_reImg = cuda.mem_alloc(nPixely * nPixelx * nPixelz * 4)
-    cuda.memcpy_htod(d_reImg, reImg)
-    d_cosAlpha = cuda.mem_alloc(nPixely * nPixelx * nSteps * numGroup * 4)
-    d_tempc = cuda.mem_alloc(nPixely * nPixelx * nSteps * numGroup * 4)
-    d_paDataLine = cuda.mem_alloc(nSamples * 4)
     # back projection loop
     notifyCli('Reconstruction starting. Keep patient.')
-    d_xRange = cuda.mem_alloc(xRange.nbytes)
-    cuda.memcpy_htod(d_xRange, xRange)
-    d_yRange = cuda.mem_alloc(yRange.nbytes)
-    cuda.memcpy_htod(d_yRange, yRange)
-    d_zRange = cuda.mem_alloc(zRange.nbytes)
-    cuda.memcpy_htod(d_zRange, zRange)
-    d_xReceive = cuda.mem_alloc(xReceive.nbytes)
-    cuda.memcpy_htod(d_xReceive, xReceive)
-    d_yReceive = cuda.mem_alloc(yReceive.nbytes)
-    cuda.memcpy_htod(d_yReceive, yReceive)
-    # get module right before execution of function
-    MOD = SourceModule(open(KERNEL_CU_FILE, 'r').read())
-    precomp = MOD.get_function('calculate_cos_alpha_and_tempc')
-    bpk = MOD.get_function('backprojection_kernel_fast')
-    # compute cosAlpha and tempc
     st_all = time()
-    precomp(d_cosAlpha, d_tempc, d_xRange, d_yRange,
-            d_xReceive, d_yReceive, np.float32(lenR),
-            grid=(nPixelx, nPixely), block=(nSteps * numGroup, 1, 1))
-    ctx.synchronize()
-    notifyCli('Done pre-computing cosAlpha and tempc.')
-    st = time()
-    for zi in range(zSteps):
-        # find out the index of fire at each virtual plane
-        fi = zi % numGroup
-        for ni in range(nSteps):
-            # transducer index
-            ti = pulseList[fi, ni]
-            cuda.memcpy_htod(d_paDataLine, paData[:, ni, zi])
-            bpk(d_reImg, d_paDataLine, d_cosAlpha, d_tempc,
-                d_zRange, zReceive[zi], np.float32(lenR),
-                np.float32(vm), delayIdx[ti], np.float32(fs),
-                np.uint32(ti), np.uint32(nSteps * numGroup),
-                np.uint32(nSamples),
-                grid=(nPixelx, nPixely), block=(nPixelz, 1, 1))
-        et = time()
-        # use the execution time of the last loop to guess the remaining time
-        time_remaining = ((zSteps - zi - 1) * (et - st) / (zi + 1)) / 60.0
-        progress(zi + 1, zSteps, time_remaining)
-    cuda.memcpy_dtoh(reImg, d_reImg)
+    # the planes of all firing groups of a z step are submitted at once
+    reImg = backproject_volume(ctx, paData, xRange, yRange, zRange,
+                               xReceive, yReceive, zReceive, delayIdx, lenR,
+                               vm, fs, pulseList, numGroup, reconOpts,
+                               progress, outFile)
     et_all = time()
     notifyCli(
         'Total time elapsed: {:.2f} mins'.format((et_all - st_all) / 60.0))
     return reImg
 
 
+def focal_line_reconstruction(chn_data_3d, reconOpts,
+                              progress=update_progress_with_time,
+                              stational=False, outFile=None):
+    """reconstruction_3d, or reconstruction_3d_stational if stational is
+    set, on the backend chosen by focal_line_backend"""
+    reconstruction = reconstruction_3d_stational if stational\
+        else reconstruction_3d
+    backend = focal_line_backend(reconOpts)
+    notifyCli('Focal-line reconstruction on the ' + backend.upper())
+    if backend != 'cuda':
+        return reconstruction(chn_data_3d, reconOpts, None, progress,
+                              outFile)
+    ctx = cuda_context()
+    reImg = reconstruction(chn_data_3d, reconOpts, ctx, progress, outFile)
+    ctx.pop()
+    del ctx
+    return reImg
+
+
+def reconstruct_and_save(chn_data_3d, opts, ind, out_format,
+                         progress=update_progress_with_time,
+                         stational=False):
+    """focal_line_reconstruction saved as reImg_<ind>_3d in out_format and
+    returned, or, if recon.slab_memory_mb is set, reconstructed out of
+    core into reImg_<ind>_3d.h5 (None is returned)"""
+    destDir = opts['extra']['dest_dir']
+    if not opts['recon'].get('slab_memory_mb', 0):
+        reImg = focal_line_reconstruction(chn_data_3d, opts['recon'],
+                                          progress, stational)
+        save_reconstructed_image(reImg, destDir, ind, out_format, '_3d')
+        return reImg
+    dirIndex = get_directory_index(destDir)
+    if ind == -1:
+        ind = dirIndex.max_output_index('chndata')
+    fileName = 'reImg_' + str(ind) + '_3d.h5'
+    outPath = os.path.join(destDir, fileName)
+    notifyCli('Saving image data to ' + outPath)
+    outFile = h5py.File(outPath, 'w')
+    try:
+        focal_line_reconstruction(chn_data_3d, opts['recon'], progress,
+                                  stational, outFile)
+    finally:
+        outFile.close()
+    dirIndex.add(fileName)
+    return None
+
+
 def reconstruct_3d_stational(opts, progress=update_progress_with_time):
     '''interface function for other python scripts such as Qt applications'''
     ind = opts['load']['EXP_START']
-    chn_data, chn_data_3d = load_hdf5_data(opts['extra']['dest_dir'], ind)
+    if opts['load'].get('lazy', False):
+        # decode z steps from the raw data files on demand
+        chn_data_3d = lazy_channel_data(opts, ind)
+    else:
+        chn_data, chn_data_3d = load_hdf5_data(opts['extra']['dest_dir'], ind)
+    if opts['display']['wi'] or opts['display']['exact']:
+        # pre-processing works on the whole array
+        chn_data_3d = np.asfortranarray(chn_data_3d)
     if opts['display']['wi']:
         notifyCli('Performing Weiner deconvolution...')
         chn_data_3d = subfunc_wiener(chn_data_3d)
     if opts['display']['exact']:
         notifyCli('Performing filtering...')
         chn_data_3d = subfunc_exact(chn_data_3d)
-    # initialize pycuda properly
-    cuda.init()
-    dev = cuda.Device(0)
-    ctx = dev.make_context()
-    reImg = reconstruction_3d_stational(chn_data_3d, opts['recon'], progress)
-    ctx.pop()
-    del ctx
-    save_reconstructed_image(reImg, opts['extra']['dest_dir'],
-                             ind, opts['recon']['out_format'], '_3d')
-    return reImg
+    return reconstruct_and_save(chn_data_3d, opts, ind,
+                                opts['recon']['out_format'], progress,
+                                stational=True)
 
 
 def reconstruct_3d(opts, progress=update_progress_with_time):
     '''interface function for other python scripts such as Qt applications'''
     ind = opts['load']['EXP_START']
-    chn_data, chn_data_3d = load_hdf5_data(opts['extra']['dest_dir'], ind)
+    if opts['load'].get('lazy', False):
+        # decode z steps from the raw data files on demand
+        chn_data_3d = lazy_channel_data(opts, ind)
+    else:
+        chn_data, chn_data_3d = load_hdf5_data(opts['extra']['dest_dir'], ind)
+    if opts['display']['wi'] or opts['display']['exact']:
+        # pre-processing works on the whole array
+        chn_data_3d = np.asfortranarray(chn_data_3d)
     if opts['display']['wi']:
         notifyCli('Performing Weiner deconvolution...')
         chn_data_3d = subfunc_wiener(chn_data_3d)
     if opts['display']['exact']:
         notifyCli('Performing filtering...')
         chn_data_3d = subfunc_exact(chn_data_3d)
-    # initialize pycuda properly
-    cuda.init()
-    dev = cuda.Device(0)
-    ctx = dev.make_context()
-    reImg = reconstruction_3d(chn_data_3d, opts['recon'], ctx, progress)
-    ctx.pop()
-    del ctx
-    save_reconstructed_image(reImg, opts['extra']['dest_dir'],
-                             ind, opts['recon']['out_format'], '_3d')
-    return reImg
+    return reconstruct_and_save(chn_data_3d, opts, ind,
+                                opts['recon']['out_format'], progress)
 
 
 @argh.arg('opts_path', type=str, help='path to YAML option file')
@@ -292,15 +553,7 @@ def reconstruct(opts_path):
         opts['extra']['dest_dir'], ind)
     if opts['unpack']['Show_Image'] != 0:
         notifyCli('Currently only Show_Image = 0 is supported.')
-    # initialize pyCuda environment
-    cuda.init()
-    dev = cuda.Device(0)
-    ctx = dev.make_context()
-    reImg = reconstruction_3d(chn_data_3d, opts['recon'])
-    ctx.pop()
-    del ctx
-    save_reconstructed_image(reImg, opts['extra']['dest_dir'],
-                             ind, 'tiff', '_3d')
+    reconstruct_and_save(chn_data_3d, opts, ind, 'tiff')
 
 if __name__ == '__main__':
     argh.dispatch_command(reconstruct)
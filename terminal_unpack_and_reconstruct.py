@@ -131,6 +131,17 @@ class ReconOptsApp(nps.NPSApp):
       self.opts['display']['exact'] = True
     return self.opts
 
+def preview_saver(opts):
+  """preview callback of reconstruct_2d saving each preview stage to
+  reImg_<index>_preview.tiff, to check a scan before the full image"""
+  def savePreview(image, stage, nStages):
+    if stage < nStages:
+      notifyCli('\nPreview {:d}/{:d}'.format(stage, nStages - 1))
+      save_reconstructed_image(image, opts['extra']['dest_dir'],
+                               opts['load']['EXP_START'], 'tiff',
+                               '_preview')
+  return savePreview
+
 def getReconOpts(defaultOpts):
   app = ReconOptsApp(defaultOpts)
   app.run()
@@ -142,7 +153,10 @@ if __name__ == '__main__':
   opts = loadOptions('default_config_linux.yaml')
   opts, action = getReconOpts(opts)
   if action == ReconActions.SLICE_2D:
-    reImg = reconstruct_2d(opts)
+    if opts['recon'].get('preview_stages'):
+      reImg = reconstruct_2d(opts, preview=preview_saver(opts))
+    else:
+      reImg = reconstruct_2d(opts)
   elif action == ReconActions.AVERAGE_2D:
     reImg = reconstruct_2d_average(opts)
   #elif action == ReconActions.STATIONAL_2D:
@@ -3,40 +3,33 @@
 
 import argh
 import os
-import re
+import shutil
+import tempfile
+import multiprocessing
 import numpy as np
 import h5py
 import time
-from unpack_speedup import daq_loop, generateChanMap
+from unpack_speedup import generateChanMap
+from daq_decode import daq_decode, LazyChannelData
 from pact_helpers import *
 
 
-def renameUnindexedFile(srcDir):
+def renameUnindexedFile(srcDir, targetFileList=None):
+  """append the next pack index to unindexed raw data files, either all
+  of them or only those in targetFileList
+  returns the new index, or -1 if there is nothing to rename
+  """
   notifyCli('Renaming unindex raw data files in ' + srcDir)
-  pTarget = re.compile(
-      r'Board[0-9]+Experiment[0-9]+TotalFiring[0-9]+_Pack.bin')
-  pExisting = re.compile(
-      r'Board([0-9]+)Experiment([0-9]+)TotalFiring([0-9]+)'
-      r'_Pack_([0-9]+).bin')
   # find unindex bin files and the max index
-  targetFileList = []
-  indexList = []
-  for fileName in os.listdir(srcDir):
-    if pTarget.match(fileName) != None:
-      targetFileList.append(fileName)
-    else:
-      matchExisting = pExisting.match(fileName)
-      if matchExisting != None:
-        indexList.append(int(matchExisting.group(4)))
+  dirIndex = get_directory_index(srcDir)
+  if targetFileList == None:
+    targetFileList = dirIndex.unindexed_files()
 
   if not targetFileList:
     notifyCli('No unindexed file found!')
     return -1
   # target index is max index + 1
-  if not indexList:
-    renameIndex = 1
-  else:
-    renameIndex = max(indexList) + 1
+  renameIndex = max(dirIndex.max_pack_index(), 0) + 1
   for fileName in targetFileList:
     srcFilePath = os.path.join(srcDir, fileName)
     destFilePath = srcFilePath[:-4] + '_' +\
@@ -44,123 +37,235 @@ def renameUnindexedFile(srcDir):
     notifyCli(srcFilePath)
     notifyCli('\t->' + destFilePath)
     os.rename(srcFilePath, destFilePath)
+    dirIndex.rename(fileName, os.path.basename(destFilePath))
 
   return renameIndex
 
 
-def readBinFile(filePath, dtype, packSize, totFirings, numExpr):
-  f = open(filePath)
-  if f == None:
-    notifyCli('File not found: ' + filePath)
-    return None
-  tempData = np.fromfile(f, dtype=dtype)
-  f.close()
-  return tempData.reshape((6 * totFirings * numExpr,
-                           packSize)).transpose()
+def readBinFile(filePath, dtype, packSize, totFirings, numExpr,
+                useMmap=False, numRows=None):
+  """read a Board*_Pack_N.bin file as a (packSize, number of packs)
+  array. If useMmap is True, the file is memory-mapped instead of being
+  loaded, and the returned array is a read-only view of the file. If
+  numRows is given, only the first numRows rows (samples) are kept.
+  """
+  shape = (6 * totFirings * numExpr, packSize)
+  if useMmap:
+    if not os.path.isfile(filePath):
+      notifyCli('File not found: ' + filePath)
+      return None
+    tempData = np.memmap(filePath, dtype=dtype, mode='r', shape=shape)
+  else:
+    f = open(filePath)
+    if f == None:
+      notifyCli('File not found: ' + filePath)
+      return None
+    tempData = np.fromfile(f, dtype=dtype).reshape(shape)
+    f.close()
+  # transposing and slicing are views, no data is copied here
+  return tempData.transpose()[0:numRows, :]
 
 
-def saveChnData(chnData, chnDataAll, destDir, ind):
+def saveChnData(chnData, chnDataAll, destDir, ind, storage=None):
+  """save channel data to chndata_<ind>.h5; see storage_options for
+  the storage settings (dtype, compression), float64 by default"""
   fileName = 'chndata_' + str(ind) + '.h5'
   outputPath = os.path.join(destDir, fileName)
   notifyCli('Saving data to ' + outputPath)
   f = h5py.File(outputPath, 'w')
-  f['chndata'] = chnData
-  f['chndata_all'] = chnDataAll
+  write_chn_dataset(f, 'chndata', chnData, storage)
+  write_chn_dataset(f, 'chndata_all', chnDataAll, storage)
   f.close()
+  get_directory_index(destDir, refresh=False).add(fileName)
 
 
-def read_channel_data(opts):
+def decode_threads(opts):
+  """number of threads decoding boards and experiment ranges; by default
+  the CPUs are shared among the unpacking worker processes"""
+  numThreads = opts['extra'].get('decode_threads', 0)
+  if numThreads <= 0:
+    numWorkers = max(opts['extra'].get('workers', 1), 1)
+    numThreads = max(multiprocessing.cpu_count() // numWorkers, 1)
+  return numThreads
+
+
+def read_pack_data(opts, ind, dirIndex):
+  """read (or memory-map) raw data files of a single index
+  returns the list of per-board pack data and the number of
+  experiments, or (None, -1) if no file is found
+  """
   srcDir = opts['extra']['src_dir']
-  destDir = opts['extra']['dest_dir']
-  startInd = opts['load']['EXP_START']
-  endInd = opts['load']['EXP_END']
   packSize = opts['unpack']['PackSize']
   totFirings = opts['unpack']['TotFirings']
   numBoards = opts['unpack']['NumBoards']
+  dataBlockSize = opts['unpack']['DataBlockSize']
 
-  if startInd == -1 or endInd == -1:
-    nextInd = renameUnindexedFile(srcDir)
-    if nextInd == -1:
-      return
-    startInd = nextInd
-    endInd = nextInd
+  packData = []  # list of pack data
+  # look up "experiment" (z step) number for this particular index
+  numExprList = dirIndex.experiment_numbers(ind, totFirings)
+  if len(numExprList) > 1:
+    notifyCli('Warning: multiple' +
+              '\"experiment\" numbers found!' +
+              ' Largest found will be used.')
+  numExpr = numExprList[-1] if numExprList else -1
+  if numExpr == -1:
+    notifyCli('Warning: no file found. Skipping index '
+              + str(ind))
+    return None, -1  # no file to process, skip this index
+  for boardId in range(numBoards):
+    boardName = opts['unpack']['BoardName'][boardId]
+    fileName = boardName + 'Experiment' + str(numExpr) +\
+        'TotalFiring' + str(totFirings) + '_Pack_' +\
+        str(ind) + '.bin'
+    filePath = os.path.join(srcDir, fileName)
+    tempData = readBinFile(filePath,
+                           opts['extra']['dtype'],
+                           packSize, totFirings, numExpr,
+                           useMmap=opts['extra'].get('use_mmap', False),
+                           numRows=2 * dataBlockSize)
+    packData.append(tempData)
+
+  return packData, numExpr
+
+
+def unpack_index(opts, ind, dirIndex):
+  """unpack raw data files of a single index
+  returns (chnData, chnDataAll), or (None, None) if no file is found
+  """
+  packData, numExpr = read_pack_data(opts, ind, dirIndex)
+  if packData is None:
+    return None, None
+
+  # interpret raw data into channel format
+  # see daq_loop.c for original implementation
+  chanMap = generateChanMap(opts['unpack']['NumElements'])
+  notifyCli('Starting daq_decode...')
+  startTime = time.time()
+  chnData, chnDataAll = daq_decode(packData, chanMap, numExpr,
+                                   opts['unpack'], decode_threads(opts))
+  endTime = time.time()
+  notifyCli('daq_decode ended. ' + str(endTime - startTime) +
+            ' s elapsed.')
+  # fix bad channels
+  chnData = -chnData / numExpr
+  badChannels =\
+      [(chnInd - 1) for chnInd in opts['unpack']['BadChannels']]
+  chnData[:, badChannels] = -chnData[:, badChannels]
+  chnDataAll = np.reshape(chnDataAll,
+                          (opts['unpack']['DataBlockSize'],
+                           opts['unpack']['NumElements'],
+                           numExpr), order='F')
+  chnDataAll[:, badChannels,:] = -chnDataAll[:, badChannels,:]
+  return chnData, chnDataAll
+
+
+def lazy_channel_data(opts, ind, dirIndex=None):
+  """return chnDataAll of a single index straight from the raw data
+  files as a LazyChannelData that decodes z steps on demand (its
+  average() is chnData); raises IOError if no file is found"""
+  if dirIndex is None:
+    dirIndex = get_directory_index(opts['extra']['src_dir'])
+  if ind == -1:
+    ind = dirIndex.max_pack_index()
+  packData, numExpr = read_pack_data(opts, ind, dirIndex)
+  if packData is None:
+    raise IOError('No raw data files of index ' + str(ind) + ' in ' +
+                  opts['extra']['src_dir'])
+  chanMap = generateChanMap(opts['unpack']['NumElements'])
+  return LazyChannelData(packData, chanMap, numExpr, opts['unpack'],
+                         decode_threads(opts))
+
+
+def _unpack_index_to_file(args):
+  """worker function of the process pool: unpack one index and save it
+  to an HDF5 file in outDir, exact (float64) unless outDir is dest_dir,
+  plus a copy with the storage options in dest_dir if save_raw is set
+  and outDir is another folder. Returns the index, or -1 if skipped.
+  """
+  opts, ind, dirIndex, outDir = args
+  chnData, chnDataAll = unpack_index(opts, ind, dirIndex)
+  if chnDataAll is None:
+    return -1
+  destDir = opts['extra']['dest_dir']
+  if outDir == destDir:
+    saveChnData(chnData, chnDataAll, outDir, ind, storage_options(opts))
+    return ind
+  if opts['extra']['save_raw']:
+    saveChnData(chnData, chnDataAll, destDir, ind, storage_options(opts))
+  saveChnData(chnData, chnDataAll, outDir, ind, None)
+  return ind
+
+
+def iter_indices_parallel(opts, indList, dirIndex, numWorkers):
+  """unpack a list of indices with a pool of worker processes
+  Each worker writes its index to a chndata_<ind>.h5 file, which is read
+  back in index order as soon as it is ready. If save_raw is set and
+  the storage options are exact (see storage_is_exact), this is the file
+  saved to dest_dir. Otherwise it is a float64 file in a temporary
+  folder, so that the data matches iter_indices exactly, and the workers
+  also save a copy to dest_dir if save_raw is set.
+  yields (ind, chnDataAll) of each index that has data
+  """
+  saveRaw = opts['extra']['save_raw']
+  destDir = opts['extra']['dest_dir']
+  if saveRaw and not os.path.exists(destDir):
+    os.mkdir(destDir)
+  if saveRaw and storage_is_exact(storage_options(opts)):
+    outDir = destDir
+  else:
+    outDir = tempfile.mkdtemp(prefix='pact_unpack_')
+  notifyCli('Unpacking ' + str(len(indList)) + ' indices with ' +
+            str(numWorkers) + ' worker processes')
+  pool = multiprocessing.Pool(numWorkers)
+  try:
+    jobs = [(opts, ind, dirIndex, outDir) for ind in indList]
+    for ind in pool.imap(_unpack_index_to_file, jobs):
+      if ind != -1:
+        fileName = 'chndata_' + str(ind) + '.h5'
+        if saveRaw:
+          # the file was saved by another process, record it here too
+          get_directory_index(destDir, refresh=False).add(fileName)
+        chnData, chnDataAll = load_hdf5_data(outDir, ind)
+        if outDir != destDir:
+          os.remove(os.path.join(outDir, fileName))
+        yield ind, chnDataAll
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+    if outDir != destDir:
+      shutil.rmtree(outDir, ignore_errors=True)
 
-  fileNameList = os.listdir(srcDir)
-
-  # chn_data_list = [None] * (endInd - startInd + 1)
-  chn_data_all_list = [None] * (endInd - startInd + 1)
-
-  for ind in range(startInd, endInd + 1):
-    packData = []  # list of pack data
-    # search through file list to find "experiment" (z step)
-    # number for this particular index
-    pattern = re.compile(r'Board([0-9]+)' +
-                         r'Experiment([0-9]+)TotalFiring' +
-                         str(totFirings) + '_Pack_' +
-                         str(ind) + '.bin')
-    numExpr = -1
-    for fileName in fileNameList:
-      matchObj = pattern.match(fileName)
-      if matchObj != None:
-        _numExpr = int(matchObj.group(2))
-        if _numExpr != numExpr and numExpr != -1:
-          notifyCli('Warning: multiple' +
-                    '\"experiment\" numbers found!' +
-                    ' Last found will be used.')
-        numExpr = _numExpr
-    if numExpr == -1:
-      notifyCli('Warning: no file found. Skipping index '
-                + str(ind))
-      continue  # no file to process, skip this index
-    for boardId in range(numBoards):
-      boardName = opts['unpack']['BoardName'][boardId]
-      fileName = boardName + 'Experiment' + str(numExpr) +\
-          'TotalFiring' + str(totFirings) + '_Pack_' +\
-          str(ind) + '.bin'
-      filePath = os.path.join(srcDir, fileName)
-      tempData = readBinFile(filePath,
-                             opts['extra']['dtype'],
-                             packSize, totFirings, numExpr)
-      tempData = tempData[0:2600,:]
-      packData.append(tempData)
-
-    # interpret raw data into channel format
-    # see daq_loop.c for original implementation
-    chanMap = generateChanMap(opts['unpack']['NumElements'])
-    notifyCli('Starting daq_loop...')
-    startTime = time.time()
-    chnData, chnDataAll = daq_loop(packData[0], packData[1],
-                                   chanMap, numExpr)
-    endTime = time.time()
-    notifyCli('daq_loop ended. ' + str(endTime - startTime) +
-              ' s elapsed.')
-    # fix bad channels
-    chnData = -chnData / numExpr
-    badChannels =\
-        [(chnInd - 1) for chnInd in opts['unpack']['BadChannels']]
-    chnData[:, badChannels] = -chnData[:, badChannels]
-    chnDataAll = np.reshape(chnDataAll,
-                            (opts['unpack']['DataBlockSize'],
-                             opts['unpack']['NumElements'],
-                             numExpr), order='F')
-    chnDataAll[:, badChannels,:] = -chnDataAll[:, badChannels,:]
 
+def iter_indices(opts, indList, dirIndex):
+  """unpack a list of indices one after the other, saving each of them
+  if save_raw is set
+  yields (ind, chnDataAll) of each index that has data
+  """
+  for ind in indList:
+    chnData, chnDataAll = unpack_index(opts, ind, dirIndex)
+    if chnDataAll is None:
+      continue
     if opts['extra']['save_raw']:
       # check if the directory is there or not
       if not os.path.exists(opts['extra']['dest_dir']):
         os.mkdir(opts['extra']['dest_dir'])
       # saving channel RF data to HDF5 file
       saveChnData(chnData, chnDataAll,
-                  opts['extra']['dest_dir'], ind)
+                  opts['extra']['dest_dir'], ind, storage_options(opts))
+    yield ind, chnDataAll
 
-    # chn_data_list[endInd-startInd] = chnData
-    chn_data_all_list[ind - startInd] = chnDataAll
 
-  # arrange raw data into a big 3D matrix
-  size_of_axis = lambda x, ind: (x.shape[ind] if x != None else 0)
-  z_steps = [size_of_axis(x, 2) for x in chn_data_all_list]
-  time_seq_len_list = [size_of_axis(x, 0) for x in chn_data_all_list]
-  detector_num_list = [size_of_axis(x, 1) for x in chn_data_all_list]
+def stack_channel_data(chnDataIter):
+  """arrange per-index channel data into a big 3D matrix in memory"""
+  chn_data_all_list = [chnDataAll for ind, chnDataAll in chnDataIter]
+  if not chn_data_all_list:
+    return None, None
+  z_steps = [x.shape[2] for x in chn_data_all_list]
+  time_seq_len_list = [x.shape[0] for x in chn_data_all_list]
+  detector_num_list = [x.shape[1] for x in chn_data_all_list]
   num_z_step = sum(z_steps)
   time_seq_len = max(time_seq_len_list)
   detector_num = max(detector_num_list)
@@ -168,15 +273,126 @@ def read_channel_data(opts):
                          order='F', dtype=np.double)
   zInd = 0
   for chn_data_all in chn_data_all_list:
-    if chn_data_all != None:
-      zSize = chn_data_all.shape[2]
-      chn_data_3d[:,:, zInd:zInd+zSize] = chn_data_all
-      zInd += zSize
+    zSize = chn_data_all.shape[2]
+    chn_data_3d[:,:, zInd:zInd+zSize] = chn_data_all
+    zInd += zSize
   # averaging over z steps
   chn_data = np.mean(chn_data_3d, axis=2)
   return chn_data, chn_data_3d
 
 
+class StreamedChannelData:
+  """array-like, read-only stand-in for the chndata_all dataset of a file
+  written by stream_channel_data. The file is only opened while data are
+  read, so no handle outlives a read, and samples are decoded to float64
+  as read_chn_dataset does."""
+  def __init__(self, path, name='chndata_all'):
+    self.path = path
+    self.name = name
+    with h5py.File(path, 'r') as f:
+      dset = f[name]
+      self.shape = dset.shape
+      self.scale = dset.attrs.get('scale_factor', None)
+    self.ndim = 3
+    self.dtype = np.dtype(np.double)
+
+  def __len__(self):
+    return self.shape[0]
+
+  def __getitem__(self, key):
+    with h5py.File(self.path, 'r') as f:
+      data = np.asarray(f[self.name][key], dtype=np.double)
+    if self.scale != None:
+      data /= self.scale
+    return data
+
+  def __array__(self, dtype=None):
+    with h5py.File(self.path, 'r') as f:
+      data = read_chn_dataset(f[self.name])
+    if dtype != None:
+      data = data.astype(dtype)
+    return data
+
+
+def stream_channel_data(chnDataIter, outPath, storage=None):
+  """append per-index channel data to a resizable HDF5 dataset as soon as
+  each index is decoded, so that only one index is held in memory
+  The file has the same layout and storage options as the
+  chndata_<ind>.h5 files, and the average over z steps is kept as a
+  running sum.
+  returns chn_data and a StreamedChannelData reading chndata_all back
+  from the file
+  """
+  notifyCli('Streaming channel data to ' + outPath)
+  f = h5py.File(outPath, 'w')
+  dset = None
+  chnSum = None
+  zInd = 0
+  for ind, chnDataAll in chnDataIter:
+    (nSamples, nElements, zSize) = chnDataAll.shape
+    if dset is None:
+      scale = chn_scale_factor(storage, chnDataAll.shape)
+      dset = f.create_dataset('chndata_all',
+                              shape=(nSamples, nElements, 0),
+                              maxshape=(nSamples, nElements, None),
+                              **chn_dataset_kwargs(storage,
+                                                   chnDataAll.shape))
+      if scale != None:
+        dset.attrs['scale_factor'] = scale
+      chnSum = np.zeros((nSamples, nElements), order='F')
+    elif dset.shape[0:2] != (nSamples, nElements):
+      notifyCli('Warning: data size of index ' + str(ind) +
+                ' does not match. Skipping.')
+      continue
+    dset.resize(zInd + zSize, axis=2)
+    dset[:, :, zInd:zInd+zSize] = encode_chn_data(chnDataAll, storage, scale)
+    for z in range(zSize):
+      chnSum += chnDataAll[:, :, z]
+    zInd += zSize
+  if dset is None:
+    f.close()
+    os.remove(outPath)
+    return None, None
+  # averaging over z steps
+  chn_data = chnSum / zInd
+  write_chn_dataset(f, 'chndata', chn_data, storage)
+  f.close()
+  return chn_data, StreamedChannelData(outPath)
+
+
+def read_channel_data(opts):
+  srcDir = opts['extra']['src_dir']
+  destDir = opts['extra']['dest_dir']
+  startInd = opts['load']['EXP_START']
+  endInd = opts['load']['EXP_END']
+  numWorkers = opts['extra'].get('workers', 1)
+
+  if startInd == -1 or endInd == -1:
+    nextInd = renameUnindexedFile(srcDir)
+    if nextInd == -1:
+      return
+    startInd = nextInd
+    endInd = nextInd
+
+  dirIndex = get_directory_index(srcDir)
+  indList = range(startInd, endInd + 1)
+
+  if numWorkers > 1 and len(indList) > 1:
+    chnDataIter = iter_indices_parallel(
+        opts, indList, dirIndex, min(numWorkers, len(indList)))
+  else:
+    chnDataIter = iter_indices(opts, indList, dirIndex)
+
+  if opts['extra'].get('stream', False):
+    if not os.path.exists(destDir):
+      os.mkdir(destDir)
+    fileName = 'chndata_' + str(startInd) + '-' + str(endInd) + '.h5'
+    return stream_channel_data(chnDataIter,
+                               os.path.join(destDir, fileName),
+                               storage_options(opts))
+  return stack_channel_data(chnDataIter)
+
+
 def pre_process(chn_data, chn_data_3d, opts):
   if (opts['display']['wi'] or
           opts['display']['pc'] or
@@ -198,8 +414,10 @@ def unpack(opts):
 @argh.arg('-p', '--path-to-data-folder', type=str,
           help='path to the data folder')
 @argh.arg('-ns', '--no-save', help='flag to override saving raw data option')
+@argh.arg('-w', '--workers', type=int,
+          help='number of worker processes unpacking indices in parallel')
 def main(opt_file='default_config_linux.yaml',
-         path_to_data_folder='', no_save=False):
+         path_to_data_folder='', no_save=False, workers=0):
   # read and process YAML file
   opts = loadOptions(opt_file)
   if path_to_data_folder != '':
@@ -217,6 +435,8 @@ def main(opt_file='default_config_linux.yaml',
   if no_save:
     notifyCli('Overriding the save_raw flag to False')
     opts['extra']['save_raw'] = False
+  if workers > 0:
+    opts['extra']['workers'] = workers
 
   unpack(opts)
 
@@ -105,6 +105,89 @@ def daq_loop(np.ndarray[unsigned int, ndim=2] packData1,
 
     return chndata, chndata_all
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _daq_decode_range(const unsigned int[:, :] pack_data,
+                            const Py_ssize_t[:] dest_channels,
+                            const Py_ssize_t[:] columns,
+                            const Py_ssize_t[:] parity,
+                            const unsigned int[:] shifts,
+                            double[:, :, :] out,
+                            Py_ssize_t exp_start, Py_ssize_t exp_end,
+                            Py_ssize_t out_start, Py_ssize_t tot_firings,
+                            double num_elements,
+                            Py_ssize_t firing_start, Py_ssize_t firing_end,
+                            double[:, :] acc, bint accumulate,
+                            unsigned int[::1] words) nogil:
+    cdef Py_ssize_t DataBlockSize = out.shape[2]
+    cdef Py_ssize_t NumDaqChnsBoard = columns.shape[0]
+    cdef Py_ssize_t PacksPerFiring = 0
+    cdef Py_ssize_t N, F, C, P, j, counter, row, channel
+    cdef unsigned int shift, hex3ff = 1023
+    cdef unsigned long long total
+    cdef double mean_data, value
+    for C in range(NumDaqChnsBoard):
+        if columns[C] + 1 > PacksPerFiring:
+            PacksPerFiring = columns[C] + 1
+    # pack columns are strided in pack_data, so each one is copied once
+    # to words and its fields are read from the copy
+    for N in range(exp_start, exp_end):
+        for F in range(firing_start, firing_end):
+            for P in range(PacksPerFiring):
+                counter = (N * tot_firings + F) * PacksPerFiring + P
+                for j in range(2 * DataBlockSize):
+                    words[j] = pack_data[j, counter]
+                for C in range(NumDaqChnsBoard):
+                    if columns[C] != P:
+                        continue
+                    row = parity[C]
+                    shift = shifts[C]
+                    channel = dest_channels[C * tot_firings + F]
+                    total = 0
+                    for j in range(DataBlockSize):
+                        total += (words[j*2+row] >> shift) & hex3ff
+                    mean_data = <double>total / <double>DataBlockSize
+                    for j in range(DataBlockSize):
+                        value = (<double>((words[j*2+row] >> shift) & hex3ff)
+                                 - mean_data) / -num_elements
+                        out[N - out_start, channel, j] = value
+                        if accumulate:
+                            acc[channel, j] -= value
+
+def daq_decode_range(pack_data, dest_channels, columns, parity, shifts,
+                     double[:, :, :] out, Py_ssize_t exp_start,
+                     Py_ssize_t exp_end, Py_ssize_t out_start,
+                     Py_ssize_t tot_firings, double num_elements,
+                     firings=None, double[:, :] acc=None):
+    """decode experiments [exp_start, exp_end) of one board into
+    out[exp_start-out_start:exp_end-out_start], out being the
+    (experiments, elements, samples) transposed view of chndata_all.
+    firings: (first, last + 1) firings to decode, all by default
+    acc: optional (elements, samples) array, the transposed view of
+         chndata, from which each decoded sample is subtracted, in
+         experiment order
+    See daq_decode.py for the meaning of the other arguments. The GIL is
+    released while decoding, so boards and experiment (or firing) ranges
+    can be decoded concurrently from a thread pool.
+    """
+    cdef const unsigned int[:, :] pack_view = pack_data
+    cdef const Py_ssize_t[:] dest_view = dest_channels
+    cdef const Py_ssize_t[:] columns_view = columns
+    cdef const Py_ssize_t[:] parity_view = parity
+    cdef const unsigned int[:] shifts_view = shifts
+    cdef Py_ssize_t firing_start = 0, firing_end = tot_firings
+    cdef bint accumulate = acc is not None
+    cdef unsigned int[::1] words = np.empty(2 * out.shape[2],
+                                            dtype=np.uint32)
+    if firings is not None:
+        firing_start, firing_end = firings
+    with nogil:
+        _daq_decode_range(pack_view, dest_view, columns_view, parity_view,
+                          shifts_view, out, exp_start, exp_end, out_start,
+                          tot_firings, num_elements, firing_start,
+                          firing_end, acc, accumulate, words)
+
 @cython.boundscheck(False)
 def recon_loop(np.ndarray[DTYPE_t, ndim=2] pa_data,
                np.ndarray[np.uint_t, ndim=3] idxAll,
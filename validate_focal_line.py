@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# validate_focal_line.py
+"""check the compiled CPU focal-line backprojection against the same
+single precision math written with numpy, and against the CUDA kernels
+if pycuda finds a device"""
+
+import argh
+import numpy as np
+from time import time
+from recon_loop import focal_line_precompute, focal_line_backproject
+
+N_STEPS = 512
+N_SAMPLES = 1300
+
+
+def reference_precompute(xRange, yRange, xReceive, yReceive, lenR):
+    """numpy float32 calculate_cos_alpha_and_tempc"""
+    lenR = np.float32(lenR)
+    dx = xRange[:, np.newaxis, np.newaxis] - xReceive
+    dy = yRange[np.newaxis, :, np.newaxis] - yReceive
+    r0 = np.sqrt(xReceive * xReceive + yReceive * yReceive)
+    rr0 = np.sqrt(dx * dx + dy * dy)
+    cosAlpha = np.abs((-xReceive * dx - yReceive * dy) / r0 / rr0)
+    tempc = rr0 - lenR / cosAlpha
+    return cosAlpha, tempc
+
+
+def reference_backproject(img, paData, cosAlpha, tempc, zRange, zReceive,
+                          transducers, delayIdx, lenR, vm, fs):
+    """numpy float32 backprojection_kernel_fast over planes and lines"""
+    lenR, vm, fs = np.float32(lenR), np.float32(vm), np.float32(fs)
+    nSamples, nLines, nPlanes = paData.shape
+    for pi in range(nPlanes):
+        dz = zRange - zReceive[pi]
+        for li in range(nLines):
+            ti = transducers[li, pi]
+            c = cosAlpha[:, :, ti, np.newaxis]
+            t = tempc[:, :, ti, np.newaxis]
+            sign = np.where(t > 0, np.float32(1), np.float32(-1))
+            root = np.sqrt(t * t + dz * dz)
+            rr0 = root * sign + lenR / c
+            inside = np.abs(dz / t) < np.abs(10.0 / np.double(lenR) /
+                                            c.astype(np.double))
+            weight = t / root * c / (rr0 * rr0)
+            # lround rounds halfway cases away from zero
+            pos = ((rr0 / vm - delayIdx[ti]) * fs).astype(np.double)
+            idx = np.sign(pos) * np.floor(np.abs(pos) + 0.5)
+            inside &= (idx >= 0) & (idx < nSamples)
+            idx = np.where(inside, idx, 0).astype(np.intp)
+            img[inside] += (paData[idx, li, pi] / weight)[inside]
+
+
+@argh.arg('-n', '--n-pixels', type=int, help='pixels along x, y and z')
+@argh.arg('-p', '--planes', type=int, help='scanning planes')
+@argh.arg('-t', '--threads', type=int, help='threads of the CPU backend')
+def main(n_pixels=24, planes=4, threads=4):
+    rng = np.random.RandomState(0)
+    lenR, vm, fs, R = 38.0, 1.51, 40.0, 50.0
+    axis = np.linspace(-5, 5, n_pixels).astype(np.float32)
+    xRange = axis
+    yRange = axis[::-1].copy()
+    zRange = (axis + 1.0).astype(np.float32)
+    angle = (np.arange(N_STEPS) * 2 * np.pi / N_STEPS).astype(np.float32)
+    xReceive = np.cos(angle) * np.float32(R)
+    yReceive = np.sin(angle) * np.float32(R)
+    delayIdx = (rng.rand(N_STEPS) * 0.5).astype(np.float32)
+    nLines = N_STEPS // 8
+    paData = np.asfortranarray(rng.randn(N_SAMPLES, nLines, planes),
+                               dtype=np.float32)
+    transducers = np.asfortranarray(
+        [rng.permutation(N_STEPS)[0:nLines] for pi in range(planes)],
+        dtype=np.int32).T.copy(order='F')
+    zReceive = (np.arange(planes) * 0.5).astype(np.float32)
+    st = time()
+    cosAlpha, tempc = focal_line_precompute(xRange, yRange, xReceive,
+                                            yReceive, lenR, threads)
+    img = np.zeros((n_pixels, n_pixels, n_pixels), dtype=np.float32)
+    focal_line_backproject(img, paData, cosAlpha, tempc, zRange, zReceive,
+                           transducers, delayIdx, lenR, vm, fs, threads)
+    print('cpu:       {:.3f} s'.format(time() - st))
+    st = time()
+    refCosAlpha, refTempc = reference_precompute(xRange, yRange, xReceive,
+                                                 yReceive, lenR)
+    ref = np.zeros_like(img)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reference_backproject(ref, paData, refCosAlpha, refTempc, zRange,
+                              zReceive, transducers, delayIdx, lenR, vm, fs)
+    print('reference: {:.3f} s'.format(time() - st))
+    print('tables identical: {}'.format(
+        np.array_equal(cosAlpha, refCosAlpha) and
+        np.array_equal(tempc, refTempc)))
+    print('image identical:  {} ({:d} nonzero voxels)'.format(
+        np.array_equal(img, ref), np.count_nonzero(img)))
+    try:
+        import pycuda.autoinit
+        from reconstruct_unpacked_3d import KERNEL_CU_FILE
+        from pycuda.compiler import SourceModule
+        import pycuda.driver as cuda
+    except Exception:
+        print('cuda:      not available')
+        return
+    mod = SourceModule(open(KERNEL_CU_FILE, 'r').read())
+    precomp = mod.get_function('calculate_cos_alpha_and_tempc')
+    bpk = mod.get_function('backprojection_kernel_fast')
+    gpuCosAlpha = np.zeros_like(cosAlpha)
+    gpuTempc = np.zeros_like(tempc)
+    precomp(cuda.Out(gpuCosAlpha), cuda.Out(gpuTempc), cuda.In(xRange),
+            cuda.In(yRange), cuda.In(xReceive), cuda.In(yReceive),
+            np.float32(lenR), grid=(n_pixels, n_pixels),
+            block=(N_STEPS, 1, 1))
+    gpuImg = np.zeros_like(img)
+    d_img = cuda.to_device(gpuImg)
+    d_cosAlpha = cuda.to_device(gpuCosAlpha)
+    d_tempc = cuda.to_device(gpuTempc)
+    for pi in range(planes):
+        for li in range(nLines):
+            ti = transducers[li, pi]
+            bpk(d_img, cuda.In(np.ascontiguousarray(paData[:, li, pi])),
+                d_cosAlpha, d_tempc, cuda.In(zRange), zReceive[pi],
+                np.float32(lenR), np.float32(vm), delayIdx[ti],
+                np.float32(fs), np.uint32(ti), np.uint32(N_STEPS),
+                np.uint32(N_SAMPLES), grid=(n_pixels, n_pixels),
+                block=(n_pixels, 1, 1))
+    cuda.memcpy_dtoh(gpuImg, d_img)
+    # the GPU fuses multiply-adds, so only agreement is expected
+    error = np.abs(gpuImg - img).max() / np.abs(img).max()
+    print('cuda:      max difference {:.2e} of the peak'.format(error))
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
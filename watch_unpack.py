@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# watch_unpack.py
+
+import argh
+import os
+import copy
+import time
+import multiprocessing
+import numpy as np
+from pact_helpers import *
+from unpack_data import renameUnindexedFile, iter_indices
+
+try:
+  import pyinotify
+except ImportError:
+  pyinotify = None
+
+
+def expected_file_size(opts, numExpr):
+  """size in bytes of a complete Board*_Pack.bin file"""
+  return 6 * opts['unpack']['TotFirings'] * numExpr *\
+      opts['unpack']['PackSize'] * np.dtype(opts['extra']['dtype']).itemsize
+
+
+def _reconstruct_index(opts, ind):
+  """worker function of the reconstruction queue"""
+  # imported here so that watching does not depend on recon_loop
+  from reconstruct_unpacked import reconstruct_2d
+  opts = copy.deepcopy(opts)
+  opts['load']['EXP_START'] = ind
+  opts['load']['EXP_END'] = ind
+  reconstruct_2d(opts, progress=lambda current, total: None)
+  return ind
+
+
+class AcquisitionWatcher:
+  """watch src_dir for completed sets of unindexed Board*_Pack.bin
+  files, index them the same way renameUnindexedFile does and unpack
+  them into dest_dir right away. A set is complete when every board
+  listed in BoardName has a file with the same experiment number and
+  the expected size, and the sizes did not change since the last poll.
+  If recon is True, a 2D reconstruction of each unpacked index is
+  queued to a separate process, whose failures are reported once the
+  reconstruction is done.
+  """
+  def __init__(self, opts, recon=False, pollInterval=2.0, usePolling=False):
+    self.opts = copy.deepcopy(opts)
+    self.opts['extra']['save_raw'] = True
+    self.srcDir = self.opts['extra']['src_dir']
+    self.recon = recon
+    self.pollInterval = pollInterval
+    self.lastSizes = {}
+    self.reconPool = None
+    self.reconResults = []
+    self.notifier = None
+    if pyinotify != None and not usePolling:
+      wm = pyinotify.WatchManager()
+      self.notifier = pyinotify.Notifier(wm, lambda event: None)
+      wm.add_watch(self.srcDir,
+                   pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO)
+
+  def completed_sets(self):
+    """return lists of file names of the complete acquisitions"""
+    dirIndex = get_directory_index(self.srcDir, refresh=False)
+    dirIndex.refresh(force=True)
+    boardNames = self.opts['unpack']['BoardName']
+    totFirings = self.opts['unpack']['TotFirings']
+    groups = {}
+    sizes = {}
+    for fileName in dirIndex.unindexed_files():
+      board, numExpr, firings, packInd = dirIndex.rawFiles[fileName]
+      if firings != totFirings or board not in boardNames:
+        continue
+      try:
+        sizes[fileName] = os.path.getsize(
+            os.path.join(self.srcDir, fileName))
+      except OSError:
+        continue
+      groups.setdefault(numExpr, []).append(fileName)
+    setList = []
+    for numExpr, fileList in sorted(groups.items()):
+      if len(fileList) != len(boardNames):
+        continue
+      expectedSize = expected_file_size(self.opts, numExpr)
+      if all([sizes[f] == expectedSize and
+              self.lastSizes.get(f) == sizes[f] for f in fileList]):
+        setList.append(sorted(fileList))
+    self.lastSizes = sizes
+    return setList
+
+  def unpack_set(self, fileList):
+    """index one complete set of files and unpack it"""
+    ind = renameUnindexedFile(self.srcDir, fileList)
+    if ind == -1:
+      return -1
+    destDir = self.opts['extra']['dest_dir']
+    if not os.path.exists(destDir):
+      os.mkdir(destDir)
+    dirIndex = get_directory_index(self.srcDir)
+    for _ in iter_indices(self.opts, [ind], dirIndex):
+      pass
+    if self.recon:
+      if self.reconPool == None:
+        self.reconPool = multiprocessing.Pool(1)
+      notifyCli('Queueing 2D reconstruction of index ' + str(ind))
+      result = self.reconPool.apply_async(_reconstruct_index,
+                                          (self.opts, ind))
+      self.reconResults.append((ind, result))
+    return ind
+
+  def check_reconstructions(self):
+    """report queued reconstructions that are done
+    returns the list of indices whose reconstruction failed
+    """
+    failed = []
+    pending = []
+    for ind, result in self.reconResults:
+      if not result.ready():
+        pending.append((ind, result))
+        continue
+      try:
+        result.get()
+      except Exception as e:
+        notifyCli('Error: 2D reconstruction of index ' + str(ind) +
+                  ' failed: ' + repr(e))
+        failed.append(ind)
+    self.reconResults = pending
+    return failed
+
+  def poll(self):
+    """unpack every set completed since the last call
+    returns the list of new indices
+    """
+    self.check_reconstructions()
+    return [self.unpack_set(fileList) for fileList in self.completed_sets()]
+
+  def wait(self):
+    """wait for file system events, or for pollInterval seconds"""
+    if self.notifier != None:
+      if self.notifier.check_events(timeout=int(self.pollInterval * 1000)):
+        self.notifier.read_events()
+        self.notifier.process_events()
+    else:
+      time.sleep(self.pollInterval)
+
+  def run(self, maxIdle=None):
+    """keep polling until maxIdle seconds pass without new data
+    (forever if maxIdle is None)
+    """
+    notifyCli('Watching ' + self.srcDir + ' for new acquisitions')
+    lastActivity = time.time()
+    try:
+      while maxIdle == None or time.time() - lastActivity < maxIdle:
+        if self.poll() or self.lastSizes:
+          lastActivity = time.time()
+        self.wait()
+    except KeyboardInterrupt:
+      notifyCli('Stopped watching ' + self.srcDir)
+    finally:
+      self.close()
+
+  def close(self):
+    """wait for queued reconstructions to finish and report failures"""
+    if self.reconPool != None:
+      self.reconPool.close()
+      self.reconPool.join()
+      self.reconPool = None
+      self.check_reconstructions()
+    if self.notifier != None:
+      self.notifier.stop()
+      self.notifier = None
+
+
+@argh.arg('-o', '--opt-file', type=str, help='YAML file of options')
+@argh.arg('-p', '--path-to-data-folder', type=str,
+          help='path to the data folder')
+@argh.arg('-r', '--recon', help='queue a 2D reconstruction of each index')
+@argh.arg('-i', '--poll-interval', type=float,
+          help='seconds between two scans of the data folder')
+@argh.arg('--use-polling', help='do not use inotify even if available')
+def main(opt_file='default_config_linux.yaml', path_to_data_folder='',
+         recon=False, poll_interval=2.0, use_polling=False):
+  # read and process YAML file
+  opts = loadOptions(opt_file)
+  if path_to_data_folder != '':
+    # put user defined path to data folder and unpack folder to opt struct.
+    srcDir = os.path.normpath(path_to_data_folder)
+    destDir = os.path.normpath(srcDir + '/unpack')
+    opts['extra']['src_dir'] = srcDir
+    opts['extra']['dest_dir'] = destDir
+  # normalize paths according to the platform
+  opts['extra']['src_dir'] =\
+      os.path.expanduser(os.path.normpath(opts['extra']['src_dir']))
+  opts['extra']['dest_dir'] =\
+      os.path.expanduser(os.path.normpath(opts['extra']['dest_dir']))
+
+  watcher = AcquisitionWatcher(opts, recon=recon,
+                               pollInterval=poll_interval,
+                               usePolling=use_polling)
+  watcher.run()
+
+if __name__ == '__main__':
+  argh.dispatch_command(main)